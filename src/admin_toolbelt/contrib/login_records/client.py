@@ -1,9 +1,19 @@
 import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import random
 import re
+import threading
+import time
 
 import requests
 
 
+logger = logging.getLogger(__name__)
+
 PATTERNS = {
     'ssh': ( 
           r'(?P<when>\w{3}\s+\d+ \d{2}:\d{2}:\d{2}) (?P<host>\S+) '
@@ -12,6 +22,166 @@ PATTERNS = {
     ),
 }
 
+# Substrings every line matching the pattern must contain, checked before the
+# much slower regular expression
+PREFILTERS = {
+    'ssh': 'Accepted ',
+}
+
+_compiled = {}
+
+
+def compile_patterns(patterns):
+    """Returns a list of ``(prefilter, regex)`` for the given labels, with
+    the regular expressions compiled once and shared.
+    """
+    result = []
+    for label in patterns:
+        if label not in _compiled:
+            _compiled[label] = re.compile(PATTERNS[label])
+        prefilter = PREFILTERS.get(label)
+        result.append((prefilter.encode() if prefilter else None, _compiled[label]))
+    return result
+
+
+class LogScanner(object):
+    """Scans a log file for lines matching the given patterns, starting where
+    the previous scan stopped.
+
+    If ``checkpoint`` is a path, the inode and byte offset of the last line
+    handled are saved to it as JSON every ``checkpoint_every`` lines and at
+    the end of the file, so a scan resumes from there. If the log has since
+    been rotated, the rest of the old file is read first when it can still
+    be found next to the log, as ``path.1`` or under any other name, before
+    the new one is read from the start. Lines are only counted as
+    handled once the caller has asked for the next match, so a crash can at
+    worst repeat the last few records rather than lose them.
+    """
+    def __init__(self, path, patterns=['ssh'], checkpoint=None, checkpoint_every=1000):
+        self.path, self.checkpoint = path, checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.matchers = compile_patterns(patterns)
+        self.inode, self.offset = None, 0
+        self._load()
+
+    def _load(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.inode, self.offset = state.get('inode'), state.get('offset', 0)
+
+    def save(self):
+        if not self.checkpoint:
+            return
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'path': self.path, 'inode': self.inode, 'offset': self.offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint)
+
+    def match(self, line):
+        """Returns the first match for a line, given as bytes, or None."""
+        for prefilter, regex in self.matchers:
+            if prefilter is not None and prefilter not in line:
+                continue
+            m = regex.search(line.decode('utf-8', 'replace').rstrip())
+            if m:
+                return m
+        return None
+
+    def _find_rotated(self):
+        """Returns the path the checkpointed file was rotated to, or None."""
+        directory = os.path.dirname(self.path) or '.'
+        candidates = [self.path + '.1']
+        try:
+            candidates += sorted(os.path.join(directory, name) for name in os.listdir(directory))
+        except OSError:
+            pass
+        for candidate in candidates:
+            try:
+                st = os.stat(candidate)
+            except OSError:
+                continue
+            if st.st_ino == self.inode and st.st_size >= self.offset:
+                return candidate
+        return None
+
+    def _open(self):
+        f = open(self.path, 'rb')
+        st = os.fstat(f.fileno())
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.inode, self.offset = st.st_ino, 0
+        f.seek(self.offset)
+        return f
+
+    def _read(self, f):
+        """Yields matches from f until its end, advancing the offset past
+        each complete line.
+        """
+        count = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Wait for the rest of a line which is still being written
+                break
+            m = self.match(line)
+            self.offset += len(line)
+            count += 1
+            if m:
+                yield m
+            if count % self.checkpoint_every == 0:
+                self.save()
+        f.seek(self.offset)
+        self.save()
+
+    def scan(self):
+        """Yields the matches from the checkpoint to the end of the file,
+        finishing the rotated file first if the log was rotated since.
+        """
+        if self.inode is not None:
+            try:
+                rotated = os.stat(self.path).st_ino != self.inode
+            except OSError:
+                rotated = True
+            path = self._find_rotated() if rotated else None
+            if path is not None:
+                with open(path, 'rb') as f:
+                    f.seek(self.offset)
+                    for m in self._read(f):
+                        yield m
+        with self._open() as f:
+            for m in self._read(f):
+                yield m
+
+    def follow(self, poll_interval=1.0):
+        """Like ``tail -F``, yields matches as lines are appended to the log,
+        indefinitely. Rotation is detected by the path pointing at a new
+        inode, in which case the old file is finished before the new one is
+        opened, and truncation by the file shrinking.
+        """
+        f = self._open()
+        try:
+            while True:
+                for m in self._read(f):
+                    yield m
+                time.sleep(poll_interval)
+                try:
+                    st = os.stat(self.path)
+                except OSError:
+                    # Between rotation and the new file being created
+                    continue
+                if st.st_ino != self.inode:
+                    for m in self._read(f):
+                        yield m
+                    f.close()
+                    f = self._open()
+                elif st.st_size < self.offset:
+                    self.offset = 0
+                    f.seek(0)
+        finally:
+            f.close()
+
 
 def send_record(url, token, when, host, service, user, fromhost, method=None):
     payload = {
@@ -22,28 +192,237 @@ def send_record(url, token, when, host, service, user, fromhost, method=None):
     resp = requests.post(url, data=payload)
     resp.raise_for_status()
     if resp.status_code != 200:
-        raise RuntimeError('Server responded: {}'.format(r.status_code))
+        raise RuntimeError('Server responded: {}'.format(resp.status_code))
 
 
-def scan_file(path, patterns=['ssh']):
-    with open(path) as f:
-        for line in f:
-            for label in patterns:
-                m = re.search(PATTERNS[label], line.rstrip())
-                if m: 
-                    yield m
+class BatchRejected(Exception):
+    """Raised when the server refuses a batch as invalid, so that sending
+    it again won't help. ``invalid`` lists the indexes of the offending
+    records if the server named them.
+    """
+    def __init__(self, status, invalid=None):
+        super().__init__('Server rejected batch: {}'.format(status))
+        self.status, self.invalid = status, invalid
+
+
+class BatchReporter(object):
+    """Sends login records to the batch endpoint at ``url`` (the
+    ``record-logins`` view) over a single keep-alive session, as gzipped
+    JSON batches of up to ``batch_size`` records, sent at most ``max_delay``
+    seconds after the first record of a batch was added.
+
+    Records are first appended to a spool in the directory ``spool_dir``, so
+    that those not yet delivered are sent by the next reporter to use it if
+    this one crashes or the server is unavailable. Failed sends are retried
+    ``max_attempts`` times with jittered exponential backoff. Delivery is at
+    least once: a batch whose response is lost is sent again.
+
+    Records the server refuses as invalid are moved to a ``.rejected`` file
+    in the spool directory instead of holding up the rest. If the server
+    doesn't say which records of a refused batch are invalid, the batch is
+    split in halves until they are found.
+
+    For example::
+
+        with BatchReporter(url, token, '/var/spool/login_records') as reporter:
+            reporter.add(when, host, service, user, fromhost, method)
+    """
+    # Responses which mean the batch itself is at fault
+    rejected_statuses = (400, 413, 422)
+
+    def __init__(self, url, token, spool_dir, batch_size=200, max_delay=10.0, timeout=30,
+            max_attempts=5, backoff=1.0, max_backoff=60.0):
+        self.url, self.token, self.spool_dir = url, token, spool_dir
+        self.batch_size, self.max_delay, self.timeout = batch_size, max_delay, timeout
+        self.max_attempts, self.backoff, self.max_backoff = max_attempts, backoff, max_backoff
+        self.session = requests.Session()
+        os.makedirs(spool_dir, exist_ok=True)
+        self._current_path = os.path.join(spool_dir, 'current.jsonl')
+        self._current, self._count, self._first = None, 0, None
+        self._sequence = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._stop = threading.Event()
+        # Anything left in the current spool file by a previous run
+        self._rotate()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, when, host, service, user, fromhost, method=None):
+        """Spools a record, sending the spool if a batch is due."""
+        record = {
+            'when': when.isoformat() if hasattr(when, 'isoformat') else when,
+            'host': host, 'service': service, 'user': user, 'fromhost': fromhost,
+        }
+        if method is not None:
+            record['method'] = method
+        with self._lock:
+            if self._current is None:
+                self._current = open(self._current_path, 'a')
+            self._current.write(json.dumps(record) + '\n')
+            self._current.flush()
+            self._count += 1
+            if self._first is None:
+                self._first = time.monotonic()
+            due = self._count >= self.batch_size
+        if due and time.monotonic() >= self._retry_at:
+            self.flush(raise_errors=False)
+
+    def _rotate(self):
+        """Moves the current spool file aside as a batch, up to batch_size
+        records at a time, to be sent and then removed.
+        """
+        with self._lock:
+            if self._current is not None:
+                os.fsync(self._current.fileno())
+                self._current.close()
+                self._current = None
+            if os.path.exists(self._current_path):
+                self._sequence += 1
+                os.rename(self._current_path, os.path.join(
+                    self.spool_dir, '{0:020.6f}-{1:06d}.batch'.format(time.time(), self._sequence)
+                ))
+            self._count, self._first = 0, None
+
+    def _records(self, path):
+        records = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A partial line written during a crash
+                    continue
+        return records
+
+    def _post(self, records):
+        body = gzip.compress(json.dumps({'token': self.token, 'records': records}).encode())
+        for attempt in range(self.max_attempts):
+            try:
+                resp = self.session.post(self.url, data=body, timeout=self.timeout, headers={
+                    'Content-Type': 'application/json', 'Content-Encoding': 'gzip',
+                })
+                if resp.status_code in self.rejected_statuses:
+                    try:
+                        invalid = resp.json().get('invalid')
+                    except (ValueError, AttributeError):
+                        invalid = None
+                    raise BatchRejected(resp.status_code, invalid)
+                if resp.status_code < 500 and resp.status_code != 429:
+                    resp.raise_for_status()
+                    return
+                error = RuntimeError('Server responded: {}'.format(resp.status_code))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt + 1 < self.max_attempts:
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logger.warning('Sending %d records failed (%s), retrying in %.1fs',
+                    len(records), error, delay)
+                time.sleep(delay)
+        raise error
+
+    def _send(self, records, rejected):
+        """Posts records, adding those the server refuses to rejected."""
+        try:
+            self._post(records)
+        except BatchRejected as e:
+            if len(records) == 1:
+                logger.error('Server rejected login record %s', records[0])
+                rejected.extend(records)
+                return
+            invalid = set(
+                i for i in e.invalid or () if isinstance(i, int) and 0 <= i < len(records)
+            )
+            if invalid:
+                for i in sorted(invalid):
+                    logger.error('Server rejected login record %s', records[i])
+                    rejected.append(records[i])
+                parts = [[r for i, r in enumerate(records) if i not in invalid]]
+            else:
+                half = len(records) // 2
+                parts = [records[:half], records[half:]]
+            for part in parts:
+                if part:
+                    self._send(part, rejected)
+
+    def _reject(self, path, records):
+        with open(path[:-len('.batch')] + '.rejected', 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def flush(self, raise_errors=True):
+        """Sends every spooled record. If sending fails, the records stay
+        spooled and, unless raise_errors is False, the error is raised.
+        Only records the server rejects as invalid are set aside, see
+        ``BatchReporter``.
+        """
+        self._rotate()
+        with self._send_lock:
+            for path in sorted(glob.glob(os.path.join(self.spool_dir, '*.batch'))):
+                try:
+                    records, rejected = self._records(path), []
+                    for i in range(0, len(records), self.batch_size):
+                        self._send(records[i:i + self.batch_size], rejected)
+                    if rejected:
+                        self._reject(path, rejected)
+                except Exception as e:
+                    self._retry_at = time.monotonic() + self.max_backoff
+                    logger.error('Unable to send login records, keeping them spooled: %s', e)
+                    if raise_errors:
+                        raise
+                    return
+                os.remove(path)
+            self._retry_at = 0
+
+    def _run(self):
+        while not self._stop.wait(min(1.0, self.max_delay)):
+            first = self._first
+            if (first is not None and time.monotonic() - first >= self.max_delay
+                    and time.monotonic() >= self._retry_at):
+                self.flush(raise_errors=False)
+
+    def close(self):
+        """Stops the background sender and sends everything spooled. Records
+        which can't be sent are logged and left spooled for the next run.
+        """
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.flush(raise_errors=False)
+        finally:
+            self.session.close()
+
+
+def scan_file(path, patterns=['ssh'], checkpoint=None, follow=False):
+    scanner = LogScanner(path, patterns, checkpoint=checkpoint)
+    return scanner.follow() if follow else scanner.scan()
+
+
+def scan_and_report(path, url, token, year=None, patterns=['ssh'], checkpoint=None,
+        follow=False, spool_dir=None):
+    if spool_dir is not None:
+        with BatchReporter(url, token, spool_dir) as reporter:
+            _report(path, reporter.add, year, patterns, checkpoint, follow)
+    else:
+        _report(path, lambda *args: send_record(url, token, *args), year, patterns,
+            checkpoint, follow)
 
 
-def scan_and_report(path, url, token, year=None, patterns=['ssh']):
-    if year == None:
-        year = datetime.date.today().year
-    
-    for m in scan_file(path, patterns):
-        send_record(
-            url,
-            token,
+def _report(path, send, year, patterns, checkpoint, follow):
+    for m in scan_file(path, patterns, checkpoint=checkpoint, follow=follow):
+        send(
             datetime.datetime.strptime(
-                "{} {}".format(year, m.group('when')), '%Y %b %d %H:%M:%S'
+                "{} {}".format(year or datetime.date.today().year, m.group('when')),
+                '%Y %b %d %H:%M:%S'
             ),
             m.group('host'),
             m.group('service'),
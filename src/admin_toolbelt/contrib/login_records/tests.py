@@ -1,3 +1,47 @@
-from django.test import TestCase
+import datetime
+import gzip
+import json
 
-# Create your tests here.
+from django.test import RequestFactory, TestCase
+from django.utils.timezone import now
+
+from .models import LoginRecord, LoginRecordToken
+from .views import LoginRecordBatchView
+
+
+class LoginRecordBatchViewTest(TestCase):
+    def setUp(self):
+        self.token = LoginRecordToken.objects.create(
+            name='test', expires=now() + datetime.timedelta(days=1)
+        ).token
+
+    def post(self, data):
+        request = RequestFactory().post(
+            '/records/', gzip.compress(json.dumps(data).encode()),
+            content_type='application/json', HTTP_CONTENT_ENCODING='gzip',
+        )
+        return LoginRecordBatchView.as_view()(request)
+
+    def record(self, user='jdoe'):
+        return {
+            'when': '2024-01-01T00:00:00+00:00', 'host': 'host', 'service': 'sshd',
+            'user': user, 'fromhost': '10.0.0.1', 'method': 'publickey',
+        }
+
+    def test_saves_batch(self):
+        resp = self.post({'token': self.token, 'records': [self.record(), self.record('asmith')]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(LoginRecord.objects.count(), 2)
+
+    def test_rejects_invalid_records(self):
+        resp = self.post({'token': self.token, 'records': [self.record(), self.record('x' * 40)]})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.content.decode()), {'invalid': [1]})
+        self.assertEqual(LoginRecord.objects.count(), 0)
+
+    def test_rejects_malformed_records(self):
+        for records in ({'user': 'jdoe'}, 'jdoe', None, [self.record(), ['jdoe']]):
+            resp = self.post({'token': self.token, 'records': records})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.content, b'')
+        self.assertEqual(LoginRecord.objects.count(), 0)
@@ -1,5 +1,9 @@
+import gzip
+import json
+
+from django.db                  import transaction
 from django.http                import (HttpResponse, HttpResponseBadRequest, 
-                                        HttpResponseForbidden)
+                                        HttpResponseForbidden, JsonResponse)
 from django.utils.decorators    import method_decorator
 from django.utils.timezone      import now
 from django.views               import View
@@ -18,7 +22,7 @@ class LoginRecordView(View):
             )
             lrt.last_used = now()
             lrt.save()
-        except models.ObjectDoesNotExist as e:
+        except LoginRecordToken.DoesNotExist as e:
             return HttpResponseForbidden()
 
         form = LoginRecordForm(request.POST)
@@ -27,3 +31,39 @@ class LoginRecordView(View):
         form.save()
         return HttpResponse()
 
+
+@method_decorator(csrf_exempt, name='dispatch')
+class LoginRecordBatchView(View):
+    """Accepts a JSON object, optionally gzip-compressed, with a ``token``
+    and a list of ``records``, as sent by ``client.BatchReporter``. Either
+    every record is saved or, if any is invalid, none are.
+    """
+    def post(self, request):
+        try:
+            body = request.body
+            if request.META.get('HTTP_CONTENT_ENCODING', '') == 'gzip':
+                body = gzip.decompress(body)
+            data = json.loads(body.decode('utf-8'))
+            records = data['records']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            return HttpResponseBadRequest()
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            return HttpResponseBadRequest()
+
+        try:
+            lrt = LoginRecordToken.objects.get(
+                token=data.get('token', ''), expires__gt=now()
+            )
+            lrt.last_used = now()
+            lrt.save()
+        except LoginRecordToken.DoesNotExist as e:
+            return HttpResponseForbidden()
+
+        forms = [LoginRecordForm(record) for record in records]
+        invalid = [i for i, form in enumerate(forms) if not form.is_valid()]
+        if invalid:
+            return JsonResponse({'invalid': invalid}, status=400)
+        with transaction.atomic():
+            LoginRecord.objects.bulk_create([form.save(commit=False) for form in forms])
+        return JsonResponse({'saved': len(forms)})
+
@@ -0,0 +1,221 @@
+"""
+    admin_toolbelt.id_allocator
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides a way of allocating unused ``uidNumber`` and
+    ``gidNumber`` values without rescanning the directory for every new
+    entry. Used IDs are tracked in compact bitmaps, one per configured range,
+    and reservations are made atomically using either a counter entry in the
+    directory or a lock file on the local host.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+
+import ldap
+
+__all__ = [
+    'IdAllocator',
+    'IdBitmap',
+]
+
+# Maps every fully used byte to 0 and every other byte to 1, so the first byte
+# containing a free bit can be found with a single bytes.find() call.
+_FREE_BYTES = bytes(0 if i == 0xff else 1 for i in range(256))
+
+
+class IdBitmap(object):
+    """A compact set of the used IDs in the half-open range [start, stop)."""
+    def __init__(self, start, stop):
+        if stop <= start:
+            raise ValueError('Invalid ID range [{0}, {1})'.format(start, stop))
+        self.start, self.stop = start, stop
+        self.high_water = None
+        self._bits = bytearray((stop - start + 7) // 8)
+
+    def __contains__(self, n):
+        if not self.start <= n < self.stop:
+            return False
+        n -= self.start
+        return bool(self._bits[n >> 3] & (1 << (n & 7)))
+
+    def add(self, n):
+        """Marks n as used, returning False if n is outside of the range."""
+        if not self.start <= n < self.stop:
+            return False
+        if self.high_water is None or n > self.high_water:
+            self.high_water = n
+        n -= self.start
+        self._bits[n >> 3] |= 1 << (n & 7)
+        return True
+
+    def free(self, count=1, minimum=None, fill_gaps=True):
+        """Returns up to ``count`` unused IDs in ascending order. If
+        ``fill_gaps`` is False, only IDs above the high-water mark are
+        considered. IDs below ``minimum`` are never returned.
+        """
+        floor = self.start
+        if not fill_gaps and self.high_water is not None:
+            floor = self.high_water + 1
+        if minimum is not None:
+            floor = max(floor, minimum)
+
+        result = []
+        free_bytes = self._bits.translate(_FREE_BYTES)
+        index = (floor - self.start) >> 3
+        while len(result) < count:
+            index = free_bytes.find(1, index)
+            if index < 0:
+                break
+            byte = self._bits[index]
+            for bit in range(8):
+                n = self.start + (index << 3) + bit
+                if n >= self.stop:
+                    return result
+                if n >= floor and not byte & (1 << bit):
+                    result.append(n)
+                    if len(result) == count:
+                        break
+            index += 1
+        return result
+
+
+class IdAllocator(object):
+    """Allocates unused uidNumbers (``kind='user'``) or gidNumbers
+    (``kind='group'``) from the given list of ``(start, stop)`` ranges using
+    a single directory read per call to ``allocate``.
+
+    Concurrent allocations are made safe in one of two ways:
+
+    - ``counter_dn`` names an existing entry whose ``uidNumber`` or
+      ``gidNumber`` attribute holds the next ID to hand out. It is advanced
+      with a modify which deletes the old value and adds the new one, which
+      fails if another allocator got there first, in which case the
+      allocation is retried. IDs below the counter are not reused.
+
+    - ``lock_path`` names a file used to serialize allocations on a single
+      host. It also records recently handed out IDs for ``reservation_ttl``
+      seconds so that they are not reused before their entries are created.
+      Free gaps below the high-water mark are used when ``fill_gaps`` is set.
+
+    Without either, allocations are only serialized within the process.
+
+    Assign an allocator to the ``uid_allocator`` or ``gid_allocator``
+    attribute of its client to have ``next_user_uid`` or ``next_group_gid``
+    allocate through it::
+
+        client.uid_allocator = IdAllocator(client, 'user', counter_dn=dn)
+        uid = client.next_user_uid()
+    """
+    kinds = {
+        'user': ('uidNumber', '(objectClass=posixAccount)', 'iter_users'),
+        'group': ('gidNumber', '(objectClass=posixGroup)', 'iter_groups'),
+    }
+
+    def __init__(self, client, kind='user', ranges=((1000, 60000),), counter_dn=None,
+            lock_path=None, fill_gaps=True, reservation_ttl=3600, max_retries=10):
+        if kind not in self.kinds:
+            raise ValueError('Invalid kind "{0}". Valid values are "{1}"'.format(
+                kind, ', '.join(self.kinds.keys())
+            ))
+        self.client, self.kind, self.ranges = client, kind, list(ranges)
+        self.counter_dn, self.lock_path = counter_dn, lock_path
+        self.fill_gaps, self.reservation_ttl = fill_gaps, reservation_ttl
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+
+    @property
+    def attr(self):
+        return self.kinds[self.kind][0]
+
+    def load(self, minimum=None):
+        """Reads every ID currently in use with one paged search and returns
+        a list of ``IdBitmap``, one per configured range. If ``minimum`` is
+        given, only IDs at or above it are read.
+        """
+        attr, filterstr, method = self.kinds[self.kind]
+        if minimum is not None:
+            filterstr = '(&{0}({1}>={2}))'.format(filterstr, attr, minimum)
+        bitmaps = [IdBitmap(start, stop) for start, stop in self.ranges]
+        for entry in getattr(self.client, method)(filterstr=filterstr, attrs=[attr]):
+            for n in entry.get_ints(attr):
+                for bitmap in bitmaps:
+                    if bitmap.add(n):
+                        break
+        return bitmaps
+
+    def _pick(self, bitmaps, count, minimum=None, fill_gaps=True):
+        result = []
+        for bitmap in bitmaps:
+            result.extend(bitmap.free(count - len(result), minimum=minimum, fill_gaps=fill_gaps))
+            if len(result) == count:
+                return result
+        raise RuntimeError('Unable to allocate {0} {1} values, ranges exhausted'.format(
+            count, self.attr
+        ))
+
+    def allocate(self, count=1):
+        """Reserves and returns a list of ``count`` unused IDs."""
+        with self._lock:
+            if self.counter_dn:
+                return self._allocate_counter(count)
+            if self.lock_path:
+                return self._allocate_lockfile(count)
+            return self._pick(self.load(), count, fill_gaps=self.fill_gaps)
+
+    def _read_counter(self):
+        result = self.client.conn.search_s(
+            self.counter_dn, ldap.SCOPE_BASE, attrlist=[self.attr]
+        )
+        values = result[0][1].get(self.attr) if result else None
+        if not values:
+            raise LookupError('{0} has no {1} value'.format(self.counter_dn, self.attr))
+        return int(values[0])
+
+    def _allocate_counter(self, count):
+        for attempt in range(self.max_retries):
+            current = self._read_counter()
+            # IDs below the counter are never handed out, so only entries
+            # created at or above it, usually none, need to be read
+            ids = self._pick(self.load(minimum=current), count, minimum=current)
+            try:
+                self.client.conn.modify_s(self.counter_dn, [
+                    (ldap.MOD_DELETE, self.attr, [str(current).encode()]),
+                    (ldap.MOD_ADD, self.attr, [str(ids[-1] + 1).encode()]),
+                ])
+                return ids
+            except ldap.NO_SUCH_ATTRIBUTE:
+                # Another allocator advanced the counter first
+                continue
+        raise RuntimeError('Unable to advance {0} after {1} attempts'.format(
+            self.counter_dn, self.max_retries
+        ))
+
+    def _allocate_lockfile(self, count):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                reserved = json.loads(f.read() or '{}').get('reserved', {})
+                reserved = dict((k, v) for k, v in reserved.items() if v > now)
+
+                bitmaps = self.load()
+                for n in reserved:
+                    for bitmap in bitmaps:
+                        if bitmap.add(int(n)):
+                            break
+                ids = self._pick(bitmaps, count, fill_gaps=self.fill_gaps)
+
+                for n in ids:
+                    reserved[str(n)] = now + self.reservation_ttl
+                f.seek(0)
+                f.truncate()
+                json.dump({'reserved': reserved}, f)
+                f.flush()
+                os.fsync(f.fileno())
+                return ids
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
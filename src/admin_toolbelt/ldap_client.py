@@ -6,24 +6,332 @@
     making certain operations against an LDAP server simpler.
 """
 import base64
+import collections
+import collections.abc
+import contextlib
+import functools
 import hashlib
+import logging
 import os
+import sys
+import threading
+import time
 
 import ldap
+import ldap.ldapobject
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
+
+from .metrics import MetricsRegistry
 
 __all__ = [
+    'CreateResult',
+    'LdapCache',
     'LdapClient',
+    'LdapClientPool',
+    'LdapEntry',
+    'LdapInstrumentation',
 ]
 
+logger = logging.getLogger(__name__)
+
+CreateResult = collections.namedtuple('CreateResult', 'username error')
+
+
+class LdapEntry(collections.abc.Mapping):
+    """A read-only mapping of attribute names to lists of values for a single
+    entry. The raw bytes returned by python-ldap are kept as-is and each
+    attribute is only decoded the first time it is accessed, so reading one
+    attribute of a large result set doesn't pay for decoding all of them.
+    """
+    __slots__ = ('dn', '_raw', '_decoded')
+
+    def __init__(self, raw, dn=None):
+        self.dn = dn
+        self._raw = raw
+        self._decoded = None
+
+    def __getitem__(self, attr):
+        if self._decoded is None:
+            self._decoded = {}
+        elif attr in self._decoded:
+            return self._decoded[attr]
+        values = [v.decode(errors='ignore') for v in self._raw[attr]]
+        self._decoded[attr] = values
+        return values
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __contains__(self, attr):
+        return attr in self._raw
+
+    def __repr__(self):
+        return '<LdapEntry {0!r} {1!r}>'.format(self.dn, self.to_dict())
+
+    def raw(self, attr, default=None):
+        """Returns the undecoded list of values of attr."""
+        return self._raw.get(attr, default)
+
+    def first(self, attr, default=None):
+        """Returns the first decoded value of attr."""
+        values = self._raw.get(attr)
+        return values[0].decode(errors='ignore') if values else default
+
+    def get_int(self, attr, default=None):
+        """Returns the first value of attr as an int, e.g. for uidNumber."""
+        values = self._raw.get(attr)
+        return int(values[0]) if values else default
+
+    def get_ints(self, attr):
+        return [int(v) for v in self._raw.get(attr, [])]
+
+    def to_dict(self):
+        return dict((k, self[k]) for k in self._raw)
+
+
+class LdapCache(object):
+    """A thread-safe LRU cache of entries keyed by DN for use with 
+    ``LdapClient``. Entries expire after ``ttl`` seconds, and lookups of DNs
+    which don't exist are remembered for ``negative_ttl`` seconds. At most 
+    ``maxsize`` entries are kept. The ``hits`` and ``misses`` counters can be
+    used to size the cache.
+    """
+    def __init__(self, maxsize=1024, ttl=300, negative_ttl=30):
+        self.maxsize, self.ttl, self.negative_ttl = maxsize, ttl, negative_ttl
+        self.hits, self.misses = 0, 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, dn):
+        """Returns a tuple ``(found, entry)``. ``entry`` is None for a cached
+        negative result.
+        """
+        with self._lock:
+            item = self._entries.get(dn)
+            if item is not None and item[0] > time.monotonic():
+                self._entries.move_to_end(dn)
+                self.hits += 1
+                return True, item[1]
+            if item is not None:
+                del self._entries[dn]
+            self.misses += 1
+            return False, None
+
+    def put(self, dn, entry):
+        ttl = self.ttl if entry is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[dn] = (time.monotonic() + ttl, entry)
+            self._entries.move_to_end(dn)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, dn):
+        with self._lock:
+            self._entries.pop(dn, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class LdapInstrumentation(object):
+    """Records the count, latency, result size and errors of the operations
+    made by an ``LdapClient``, per operation type and base DN, into a 
+    ``metrics.MetricsRegistry``. Operations slower than ``slow_threshold``
+    seconds are logged as warnings, and if given, ``callback`` is called as
+    ``callback(op, base, seconds, size, error)`` after every operation.
+
+    Pass an instance as the ``instrumentation`` argument of ``LdapClient`` or
+    ``LdapClientPool``. Clients created without one are not wrapped at all.
+    """
+    def __init__(self, registry=None, slow_threshold=1.0, callback=None):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.slow_threshold = slow_threshold
+        self.callback = callback
+
+    def record(self, op, base, seconds, size=None, error=None):
+        labels = (('base', base), ('op', op))
+        self.registry.inc('ldap_operations_total', labels)
+        self.registry.observe('ldap_operation_seconds', seconds, labels)
+        if size is not None:
+            self.registry.inc('ldap_result_entries_total', labels, size)
+        if error is not None:
+            self.registry.inc('ldap_operation_errors_total', labels)
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            logger.warning('Slow LDAP %s on "%s" took %.3fs', op, base, seconds)
+        if self.callback is not None:
+            self.callback(op, base, seconds, size, error)
+
+    def expose(self):
+        return self.registry.expose()
+
+
+def _base_label(dn):
+    """Collapses entry DNs to their parent to bound the number of series."""
+    if not dn or dn[:3].lower() in ('ou=', 'dc='):
+        return dn
+    return dn.split(',', 1)[-1]
+
+
+class _InstrumentedConnection(object):
+    """Wraps an LDAPObject, reporting the synchronous operations and the
+    asynchronous searches and adds made through it to an
+    ``LdapInstrumentation``. The time recorded for an asynchronous operation
+    runs until its final result has been read, so for a search it includes
+    time spent by the caller consuming entries.
+    """
+    # Responses which are followed by more for the same message
+    _partial = (ldap.RES_SEARCH_ENTRY, ldap.RES_SEARCH_REFERENCE, ldap.RES_INTERMEDIATE)
+
+    def __init__(self, conn, instrumentation):
+        self._conn = conn
+        self._instrumentation = instrumentation
+        self._pending = {}
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def _timed(self, op, base, func, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._instrumentation.record(op, base, time.monotonic() - start, error=e)
+            raise
+        self._instrumentation.record(
+            op, base, time.monotonic() - start, 
+            size=len(result) if op == 'search' else None
+        )
+        return result
+
+    def search_s(self, base, *args, **kwargs):
+        return self._timed(
+            'search', _base_label(base), self._conn.search_s, base, *args, **kwargs
+        )
+
+    def add_s(self, dn, *args, **kwargs):
+        return self._timed('add', _base_label(dn), self._conn.add_s, dn, *args, **kwargs)
+
+    def modify_s(self, dn, *args, **kwargs):
+        return self._timed('modify', _base_label(dn), self._conn.modify_s, dn, *args, **kwargs)
+
+    def start_tls_s(self):
+        return self._timed('start_tls', '', self._conn.start_tls_s)
+
+    def simple_bind_s(self, *args, **kwargs):
+        return self._timed('bind', '', self._conn.simple_bind_s, *args, **kwargs)
+
+    def _start(self, op, base, msgid):
+        self._pending[msgid] = [time.monotonic(), op, base, 0]
+        return msgid
+
+    def _received(self, msgid, rtype, rdata):
+        pending = self._pending.get(msgid)
+        if pending is None:
+            return
+        start, op, base, size = pending
+        if rtype in self._partial:
+            if rtype == ldap.RES_SEARCH_ENTRY:
+                pending[3] += len(rdata)
+            return
+        del self._pending[msgid]
+        if op == 'search':
+            # With all=1, the entries come back along with the final result
+            size += len(rdata or ())
+        self._instrumentation.record(
+            op, base, time.monotonic() - start, size=size if op == 'search' else None
+        )
+
+    def _failed(self, msgid, error):
+        pending = self._pending.pop(msgid, None)
+        if pending is not None:
+            self._instrumentation.record(
+                pending[1], pending[2], time.monotonic() - pending[0], error=error
+            )
+
+    def search_ext(self, base, *args, **kwargs):
+        return self._start(
+            'search', _base_label(base), self._conn.search_ext(base, *args, **kwargs)
+        )
+
+    def add(self, dn, *args, **kwargs):
+        return self._start('add', _base_label(dn), self._conn.add(dn, *args, **kwargs))
+
+    def result(self, msgid=ldap.RES_ANY, *args, **kwargs):
+        try:
+            result = self._conn.result(msgid, *args, **kwargs)
+        except Exception as e:
+            self._failed(msgid, e)
+            raise
+        # Only result3 and result4 say which message a response belongs to
+        if msgid != ldap.RES_ANY:
+            self._received(msgid, result[0], result[1])
+        return result
+
+    def result3(self, msgid=ldap.RES_ANY, *args, **kwargs):
+        try:
+            result = self._conn.result3(msgid, *args, **kwargs)
+        except Exception as e:
+            self._failed(msgid, e)
+            raise
+        self._received(result[2], result[0], result[1])
+        return result
+
+    def result4(self, msgid=ldap.RES_ANY, *args, **kwargs):
+        try:
+            result = self._conn.result4(msgid, *args, **kwargs)
+        except Exception as e:
+            self._failed(msgid, e)
+            raise
+        self._received(result[2], result[0], result[1])
+        return result
+
+    def abandon(self, msgid, *args, **kwargs):
+        self._pending.pop(msgid, None)
+        return self._conn.abandon(msgid, *args, **kwargs)
+
+    def reconnect(self, *args, **kwargs):
+        # Nothing pending on the old connection will get a response
+        self._pending.clear()
+        return self._conn.reconnect(*args, **kwargs)
+
 
 class LdapClient(object):
     def __init__(self, base, host, user=None, cred=None, start_tls=True, 
-            user_ou='People', group_ou='Group', username_attr='uid'):
+            user_ou='People', group_ou='Group', username_attr='uid', page_size=1000,
+            retry_max=0, retry_delay=1.0, cache=None, instrumentation=None):
         self.base = base
-        self.conn = ldap.initialize(host)
+        self.cache = cache
+        self.retry_max, self.retry_delay = retry_max, retry_delay
+        if retry_max:
+            # Reconnects, redoes StartTLS and rebinds when SERVER_DOWN is hit
+            self.conn = ldap.ldapobject.ReconnectLDAPObject(
+                host, retry_max=retry_max, retry_delay=retry_delay
+            )
+        else:
+            self.conn = ldap.initialize(host)
+        if instrumentation is not None:
+            self.conn = _InstrumentedConnection(self.conn, instrumentation)
         self.user_ou = user_ou
         self.group_ou = group_ou
         self.username_attr = username_attr
+        self.page_size = page_size
+        # Optional id_allocator.IdAllocator instances for next_user_uid and
+        # next_group_gid, which need this client to exist first
+        self.uid_allocator = self.gid_allocator = None
         if start_tls:
             self.conn.start_tls_s()
         if user and cred:
@@ -35,29 +343,115 @@ class LdapClient(object):
     def __exit__(self, *args):
         self.close()
 
-    def _search_base(self, search_string):
+    def _search_base(self, search_string, attrs=None):
+        """Returns the entry at the DN search_string, or None. With a cache,
+        the complete entry is always fetched and cached so that it can serve
+        lookups of any attrs, and attrs only narrows the search otherwise.
+        """
+        if self.cache is not None:
+            found, entry = self.cache.get(search_string)
+            if found:
+                return self._decode_entry(entry, search_string) if entry is not None else None
+            attrs = None
+
         try:
-            result = self.conn.search_s(search_string, ldap.SCOPE_SUBTREE)[0][1]
-            for k, v in result.items():
-                result[k] = [s.decode(errors='ignore') for s in v]
-            return result
+            entry = self.conn.search_s(
+                search_string, ldap.SCOPE_SUBTREE, attrlist=attrs
+            )[0][1]
+        except ldap.NO_SUCH_OBJECT as e:
+            entry = None
         except Exception as e:
             return None
 
-    def _search_base_multi(self, base, filterstr='(objectClass=*)', attrs=None):
+        if self.cache is not None:
+            self.cache.put(search_string, entry)
+        return self._decode_entry(entry, search_string) if entry is not None else None
+
+    def _invalidate(self, dn):
+        if self.cache is not None:
+            self.cache.invalidate(dn)
+
+    def _reconnect(self):
+        """Reconnects and rebinds after ``SERVER_DOWN`` was raised by one of
+        the asynchronous operations, which ``ReconnectLDAPObject`` doesn't
+        retry itself. Returns False if the client wasn't created with
+        ``retry_max`` or the server still can't be reached.
+        """
+        if not self.retry_max or not hasattr(self.conn, 'reconnect'):
+            return False
         try:
-            result = [ i[1] for i in self.conn.search_s(
-                base, ldap.SCOPE_SUBTREE, filterstr=filterstr, attrlist=attrs
-            )]
-            for index, item in enumerate(result):
-                for k, v in item.items():
-                    result[index][k] = [s.decode(errors='ignore') for s in v]
-            return result
-        except Exception as e:
-            return []
+            self.conn.reconnect(
+                self.conn._uri, retry_max=self.retry_max, retry_delay=self.retry_delay
+            )
+        except ldap.LDAPError:
+            return False
+        return True
+
+    def _decode_entry(self, entry, dn=None):
+        return LdapEntry(entry, dn)
+
+    def _search_base_multi(self, base, filterstr='(objectClass=*)', attrs=None):
+        return list(self._search_paged(base, filterstr=filterstr, attrs=attrs))
+
+    def _search_paged(self, base, filterstr='(objectClass=*)', attrs=None, page_size=None):
+        """Generator which performs a subtree search of base using the Simple 
+        Paged Results control (RFC 2696), yielding decoded entries as they are
+        received from the server. Errors are raised to the caller.
+        """
+        for dn, entry in self._search_paged_raw(base, filterstr, attrs, page_size):
+            yield self._decode_entry(entry, dn)
+
+    def _search_paged_raw(self, base, filterstr='(objectClass=*)', attrs=None, page_size=None):
+        """Like ``_search_paged``, but yields undecoded ``(dn, entry)`` tuples.
+        If the connection turns out to be lost before the first entry is
+        yielded, the client reconnects once and starts the search over.
+        """
+        control = SimplePagedResultsControl(
+            True, size=page_size or self.page_size, cookie=''
+        )
+        yielded = reconnected = False
+        while True:
+            done = False
+            try:
+                msgid = self.conn.search_ext(
+                    base, ldap.SCOPE_SUBTREE, filterstr=filterstr, attrlist=attrs,
+                    serverctrls=[control]
+                )
+                try:
+                    while True:
+                        rtype, rdata, rmsgid, rctrls = self.conn.result3(msgid, all=0)
+                        if rtype == ldap.RES_SEARCH_RESULT:
+                            done = True
+                            break
+                        for dn, entry in rdata:
+                            # Search references come back with a dn of None
+                            if dn is not None:
+                                yielded = True
+                                yield dn, entry
+                finally:
+                    if not done:
+                        self.conn.abandon(msgid)
+            except ldap.SERVER_DOWN:
+                # Entries already yielded can't be taken back, and the paging
+                # cookie is only valid on the connection which issued it
+                if yielded or reconnected or not self._reconnect():
+                    raise
+                reconnected = True
+                control.cookie = ''
+                continue
+
+            control.cookie = None
+            for c in rctrls:
+                if c.controlType == SimplePagedResultsControl.controlType:
+                    control.cookie = c.cookie
+            if not control.cookie:
+                break
 
     def _modify_base(self, search_string, action, attr, value):
-        r = self.conn.modify_s(search_string, [(action, attr, value)])
+        try:
+            r = self.conn.modify_s(search_string, [(action, attr, value)])
+        finally:
+            self._invalidate(search_string)
 
     def close(self):
         self.conn.unbind_s()
@@ -72,16 +466,16 @@ class LdapClient(object):
             groupname, self.group_ou, self.base
         )
 
-    def create_user(self, username, uid, fullname, email, password, primary_group, 
+    def _user_modlist(self, username, uid, fullname, email, password, gid, 
             surname=None, homedir='/nfs/user/{user}', shell='/bin/bash', hash_password=True):
-        self.conn.add_s(self.get_user_string(username), self.prepare_modlist({
+        return self.prepare_modlist({
             'objectClass': ['inetOrgPerson', 'organizationalPerson', 'person', 
                 'posixAccount', 'shadowAccount', 'top'],
             'cn': username,
             'sn': surname if surname else fullname.split()[-1],
             'uid': username,
             'uidNumber': uid,
-            'gidNumber': self.search_group(primary_group)['gidNumber'],
+            'gidNumber': gid,
             'homeDirectory': homedir.format(user=username),
             'loginShell': shell,
             'gecos': fullname,
@@ -90,32 +484,161 @@ class LdapClient(object):
             'shadowLastChange': 0,
             'shadowMax': 0,
             'shadowWarning': 0,
-        }))
-        self.add_user_to_group(username, primary_group)
+        })
 
-    def create_service_user(self, username, uid, password, primary_group, 
+    def _service_user_modlist(self, username, uid, password, gid, 
             homedir='/usr/local/{user}', shell='/sbin/nologin', hash_password=True):
-        self.conn.add_s(self.get_user_string(username), self.prepare_modlist({
+        return self.prepare_modlist({
             'objectClass': ['posixAccount', 'shadowAccount', 'account', 'top'],
             'cn': username,
             'uid': username,
             'uidNumber': uid,
-            'gidNumber': self.search_group(primary_group)['gidNumber'],
+            'gidNumber': gid,
             'homeDirectory': homedir.format(user=username),
             'loginShell': shell,
             'userPassword': self.hash_password(password) if hash_password else password,
             'shadowLastChange': 0,
             'shadowMax': 0,
             'shadowWarning': 0,
-        }))
+        })
+
+    def create_user(self, username, uid, fullname, email, password, primary_group, 
+            surname=None, homedir='/nfs/user/{user}', shell='/bin/bash', hash_password=True):
+        self.conn.add_s(self.get_user_string(username), self._user_modlist(
+            username, uid, fullname, email, password, 
+            self.search_group(primary_group, attrs=['gidNumber'])['gidNumber'], surname=surname, 
+            homedir=homedir, shell=shell, hash_password=hash_password
+        ))
+        self._invalidate(self.get_user_string(username))
         self.add_user_to_group(username, primary_group)
 
-    def search_user(self, username):
-        return self._search_base(self.get_user_string(username))
+    def create_service_user(self, username, uid, password, primary_group, 
+            homedir='/usr/local/{user}', shell='/sbin/nologin', hash_password=True):
+        self.conn.add_s(self.get_user_string(username), self._service_user_modlist(
+            username, uid, password, 
+            self.search_group(primary_group, attrs=['gidNumber'])['gidNumber'], 
+            homedir=homedir, shell=shell, hash_password=hash_password
+        ))
+        self._invalidate(self.get_user_string(username))
+        self.add_user_to_group(username, primary_group)
+
+    def create_users(self, users, window=64):
+        """Creates many users with pipelined requests. ``users`` is an iterable
+        of dicts of keyword arguments for ``create_user``, or for 
+        ``create_service_user`` if the dict contains ``'service': True``. Each 
+        distinct primary group is looked up once, at most ``window`` adds are
+        in flight at a time, and the new members of each group are added with
+        a single modify.
+
+        If the connection is lost and the client was created with 
+        ``retry_max``, it reconnects once and sends the adds which were in 
+        flight again. An add which had already been applied before the 
+        connection was lost is then reported as ``ALREADY_EXISTS``.
+
+        Returns a list of ``CreateResult(username, error)`` in input order, 
+        where ``error`` is None on success or the exception which occurred.
+        """
+        users = list(users)
+        errors = [None] * len(users)
+
+        gids = {}
+        for groupname in set(u['primary_group'] for u in users):
+            group = self.search_group(groupname, attrs=['gidNumber'])
+            gids[groupname] = group['gidNumber'] if group else None
+
+        in_flight = collections.deque()
+        reconnected = False
+
+        def send(index, dn, modlist):
+            try:
+                in_flight.append((self.conn.add(dn, modlist), index, dn, modlist))
+            except ldap.SERVER_DOWN as e:
+                if not reconnect():
+                    errors[index] = e
+                    return
+                send(index, dn, modlist)
+
+        def reconnect():
+            # The results of the adds in flight were lost along with the
+            # connection, so they are sent again on the new one
+            nonlocal reconnected
+            if reconnected or not self._reconnect():
+                return False
+            reconnected = True
+            lost = list(in_flight)
+            in_flight.clear()
+            for msgid, index, dn, modlist in lost:
+                send(index, dn, modlist)
+            return True
+
+        def collect():
+            msgid, index, dn, modlist = in_flight.popleft()
+            try:
+                self.conn.result(msgid)
+            except ldap.SERVER_DOWN as e:
+                in_flight.appendleft((msgid, index, dn, modlist))
+                if reconnect():
+                    return
+                in_flight.popleft()
+                errors[index] = e
+            except ldap.LDAPError as e:
+                errors[index] = e
+            # Only once the add has completed, so that a lookup made in the
+            # meantime can't cache the entry as missing
+            self._invalidate(dn)
+
+        for index, user in enumerate(users):
+            kwargs = dict(user)
+            groupname = kwargs.pop('primary_group')
+            if gids[groupname] is None:
+                errors[index] = LookupError('No such group: {0}'.format(groupname))
+                continue
+            try:
+                if kwargs.pop('service', False):
+                    modlist = self._service_user_modlist(gid=gids[groupname], **kwargs)
+                else:
+                    modlist = self._user_modlist(gid=gids[groupname], **kwargs)
+                dn = self.get_user_string(kwargs['username'])
+            except Exception as e:
+                errors[index] = e
+                continue
+            send(index, dn, modlist)
+            if len(in_flight) >= window:
+                collect()
+        while in_flight:
+            collect()
+
+        members = collections.defaultdict(list)
+        for index, user in enumerate(users):
+            if errors[index] is None:
+                members[user['primary_group']].append(index)
+        for groupname, indices in members.items():
+            try:
+                self.add_group_attr(groupname, 'memberUid', [
+                    self.prepare_attribute(users[i]['username']) for i in indices
+                ])
+            except ldap.LDAPError:
+                # Fall back to one modify per user to attribute the failure
+                for i in indices:
+                    try:
+                        self.add_user_to_group(users[i]['username'], groupname)
+                    except ldap.TYPE_OR_VALUE_EXISTS:
+                        pass
+                    except ldap.LDAPError as e:
+                        errors[i] = e
+
+        return [CreateResult(u['username'], e) for u, e in zip(users, errors)]
+
+    def search_user(self, username, attrs=None):
+        return self._search_base(self.get_user_string(username), attrs=attrs)
 
     def search_users(self, filterstr='(objectClass=*)', attrs=None):
-        return self._search_base_multi(
-            'ou={0},{1}'.format(self.user_ou, self.base), filterstr=filterstr, attrs=attrs
+        return list(self.iter_users(filterstr=filterstr, attrs=attrs))
+
+    def iter_users(self, filterstr='(objectClass=*)', attrs=None, page_size=None):
+        return self._search_paged(
+            'ou={0},{1}'.format(self.user_ou, self.base), 
+            filterstr=filterstr, attrs=attrs, page_size=page_size
         )
 
     def add_user_attr(self, username, attr, value):
@@ -128,9 +651,16 @@ class LdapClient(object):
         self._modify_base(self.get_user_string(username), ldap.MOD_DELETE, attr, value)
 
     def next_user_uid(self, filterstr='(objectClass=posixAccount)'):
+        """Returns an unused uidNumber. With ``uid_allocator`` set, it is
+        reserved through the allocator, which keeps concurrent callers from
+        getting the same one as described by ``IdAllocator``. Otherwise it is
+        one more than the highest in use by the users matching filterstr.
+        """
+        if self.uid_allocator is not None:
+            return self.uid_allocator.allocate()[0]
         return 1 + max(map(
-            lambda r: int(r['uidNumber'][0]), 
-            self.search_users(filterstr=filterstr, attrs=['uidNumber'])
+            lambda r: r.get_int('uidNumber'), 
+            self.iter_users(filterstr=filterstr, attrs=['uidNumber'])
         ))
 
     def create_group(self, groupname, gid, members=[], description=''):
@@ -141,13 +671,18 @@ class LdapClient(object):
             'description': description,
             'memberUid': members
         }))
+        self._invalidate(self.get_group_string(groupname))
 
-    def search_group(self, groupname):
-        return self._search_base(self.get_group_string(groupname))
+    def search_group(self, groupname, attrs=None):
+        return self._search_base(self.get_group_string(groupname), attrs=attrs)
 
     def search_groups(self, filterstr='(objectClass=*)', attrs=None):
-        return self._search_base_multi(
-            'ou={0},{1}'.format(self.group_ou, self.base), filterstr=filterstr, attrs=attrs
+        return list(self.iter_groups(filterstr=filterstr, attrs=attrs))
+
+    def iter_groups(self, filterstr='(objectClass=*)', attrs=None, page_size=None):
+        return self._search_paged(
+            'ou={0},{1}'.format(self.group_ou, self.base), 
+            filterstr=filterstr, attrs=attrs, page_size=page_size
         )
 
     def add_group_attr(self, groupname, attr, value):
@@ -160,11 +695,44 @@ class LdapClient(object):
         self._modify_base(self.get_group_string(groupname), ldap.MOD_DELETE, attr, value)
 
     def next_group_gid(self):
+        """Like ``next_user_uid``, but for gidNumbers and ``gid_allocator``."""
+        if self.gid_allocator is not None:
+            return self.gid_allocator.allocate()[0]
         return 1 + max(map(
-            lambda r: int(r['gidNumber'][0]), 
-            self.search_groups(filterstr='(objectClass=posixGroup)', attrs=['gidNumber'])
+            lambda r: r.get_int('gidNumber'), 
+            self.iter_groups(filterstr='(objectClass=posixGroup)', attrs=['gidNumber'])
         ))
 
+    def groups_for_user(self, username):
+        """Returns the names of the groups which list username as a member."""
+        return [g.first('cn') for g in self.iter_groups(
+            filterstr='(&(objectClass=posixGroup)(memberUid={0}))'.format(
+                escape_filter_chars(username)
+            ), 
+            attrs=['cn']
+        )]
+
+    def members_of(self, groupname):
+        """Returns the memberUid values of the given group, or None if the 
+        group doesn't exist.
+        """
+        group = self.search_group(groupname, attrs=['memberUid'])
+        return group.get('memberUid', []) if group is not None else None
+
+    def membership_index(self, page_size=None):
+        """Builds a mapping of username to the frozenset of names of the groups
+        the user is a member of, using a single paged pass over the groups. 
+        Names are interned, so each is only stored once.
+        """
+        index = collections.defaultdict(set)
+        for group in self.iter_groups(
+                filterstr='(objectClass=posixGroup)', attrs=['cn', 'memberUid'], 
+                page_size=page_size):
+            name = sys.intern(group.first('cn'))
+            for member in group.get('memberUid', []):
+                index[sys.intern(member)].add(name)
+        return dict((k, frozenset(v)) for k, v in index.items())
+
     def add_user_to_group(self, username, groupname):
         self.add_group_attr(groupname, 'memberUid', self.prepare_attribute(username))
 
@@ -199,3 +767,130 @@ class LdapClient(object):
         self.modify_user_attr(username, 'userPassword', self.hash_password(passwd))
 
 
+class LdapClientPool(object):
+    """A thread-safe pool of bound ``LdapClient`` instances. Between 
+    ``min_size`` and ``max_size`` connections are kept open, and clients which
+    have been idle for longer than ``check_interval`` seconds are health 
+    checked before being handed out. Clients are created with ``retry_max``
+    set so that a ``SERVER_DOWN`` mid-operation transparently reconnects and
+    rebinds, including for paged searches which haven't returned any entries
+    yet and for ``create_users``. Remaining keyword arguments are passed to
+    ``LdapClient``.
+
+    For example::
+
+        pool = LdapClientPool('dc=example,dc=com', 'ldap://ldap', user, cred)
+        with pool.connection() as client:
+            client.search_user('jdoe')
+    """
+    def __init__(self, base, host, user=None, cred=None, min_size=1, max_size=10,
+            timeout=None, check_interval=30, retry_max=3, retry_delay=1.0, **kwargs):
+        if not 0 <= min_size <= max_size:
+            raise ValueError('Pool sizes must satisfy 0 <= min_size <= max_size')
+        self._factory = functools.partial(
+            LdapClient, base, host, user=user, cred=cred, 
+            retry_max=retry_max, retry_delay=retry_delay, **kwargs
+        )
+        self.min_size, self.max_size = min_size, max_size
+        self.timeout, self.check_interval = timeout, check_interval
+        self._cond = threading.Condition()
+        self._idle = collections.deque()
+        self._size = 0
+        self._closed = False
+        for i in range(min_size):
+            self._idle.append((self._factory(), time.monotonic()))
+            self._size += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _healthy(self, client):
+        try:
+            client.conn.whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
+
+    def _dispose(self, client):
+        try:
+            client.close()
+        except ldap.LDAPError:
+            pass
+
+    def acquire(self):
+        """Checks out a client, blocking for up to ``timeout`` seconds while 
+        the pool is exhausted. Clients must be returned with ``release``.
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError('LdapClientPool is closed')
+                if self._idle:
+                    client, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    client, last_used = None, None
+                    self._size += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('Timed out waiting for an LDAP connection')
+                self._cond.wait(remaining)
+
+        try:
+            if client is not None and time.monotonic() - last_used > self.check_interval:
+                if not self._healthy(client):
+                    self._dispose(client)
+                    client = None
+            if client is None:
+                client = self._factory()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return client
+
+    def release(self, client, discard=False):
+        """Returns a client to the pool, or closes it if ``discard`` is set."""
+        with self._cond:
+            if discard or self._closed:
+                self._size -= 1
+            else:
+                self._idle.append((client, time.monotonic()))
+            self._cond.notify()
+        if discard or self._closed:
+            self._dispose(client)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager which checks out a client and returns it afterwards.
+        Clients whose server went away are discarded rather than reused.
+        """
+        client = self.acquire()
+        try:
+            yield client
+        except ldap.SERVER_DOWN:
+            self.release(client, discard=True)
+            raise
+        except BaseException:
+            self.release(client)
+            raise
+        else:
+            self.release(client)
+
+    def close(self):
+        """Closes all idle clients. Clients still checked out are closed as 
+        they are released.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), collections.deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for client, last_used in idle:
+            self._dispose(client)
@@ -0,0 +1,447 @@
+"""
+    admin_toolbelt.ldap_replica
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides a local, read-only replica of the user and group
+    OUs managed by an ``LdapClient``. The replica is populated with one full
+    load and then refreshed incrementally, either with the LDAP Content
+    Synchronization Operation (RFC 4533) when the server supports it, or with
+    a ``modifyTimestamp`` delta search otherwise. Lookups against the replica
+    mirror those of ``LdapClient`` but never touch the network.
+"""
+import collections
+import json
+import re
+import sqlite3
+import sys
+import threading
+
+import ldap
+from ldap.filter import escape_filter_chars
+from ldap.syncrepl import (SyncDoneControl, SyncInfoMessage, SyncRequestControl,
+                           SyncStateControl)
+
+__all__ = [
+    'LdapReplica',
+    'MemoryReplicaStore',
+    'SqliteReplicaStore',
+    'compile_filter',
+]
+
+SYNCREPL_OID = '1.3.6.1.4.1.4203.1.9.1.1'
+
+# Result code sent by the server when a sync cookie is too old to be resumed
+E_SYNC_REFRESH_REQUIRED = 4096
+
+
+def normalize_dn(dn):
+    return ','.join(rdn.strip() for rdn in dn.lower().split(','))
+
+
+def _values(entry, attr):
+    values = entry.get(attr)
+    if values is None:
+        attr = attr.lower()
+        for k, v in entry.items():
+            if k.lower() == attr:
+                return v
+        return []
+    return values
+
+
+def _unescape(value):
+    return re.sub(
+        r'\\([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value
+    ).lower()
+
+
+def _ordering(op, expected):
+    def compare(value):
+        try:
+            a, b = int(value), int(expected)
+        except ValueError:
+            a, b = value, expected
+        return a >= b if op == '>=' else a <= b
+    return compare
+
+
+def _substring(parts):
+    pattern = re.compile('^' + '.*'.join(re.escape(p) for p in parts) + '$', re.S)
+    return lambda value: pattern.match(value) is not None
+
+
+def compile_filter(filterstr):
+    """Compiles an RFC 4515 search filter into a predicate accepting a raw
+    entry, as returned by python-ldap. Supports ``&``, ``|``, ``!``,
+    presence, equality, substring, ``>=`` and ``<=`` items. Values are
+    compared case-insensitively, and numerically for ordering when possible,
+    which approximates the matching rules of the posix schema.
+    """
+    filterstr = filterstr.strip()
+    if not filterstr.startswith('('):
+        filterstr = '(' + filterstr + ')'
+
+    def parse(pos):
+        if filterstr[pos] != '(':
+            raise ValueError('Invalid filter: {0}'.format(filterstr))
+        op = filterstr[pos + 1]
+        if op in '&|!':
+            pos, subfilters = pos + 2, []
+            while filterstr[pos] == '(':
+                subfilter, pos = parse(pos)
+                subfilters.append(subfilter)
+            if filterstr[pos] != ')':
+                raise ValueError('Invalid filter: {0}'.format(filterstr))
+            if op == '&':
+                return lambda e: all(f(e) for f in subfilters), pos + 1
+            if op == '|':
+                return lambda e: any(f(e) for f in subfilters), pos + 1
+            return lambda e: not subfilters[0](e), pos + 1
+
+        end = filterstr.index(')', pos)
+        m = re.match(r'^([^=~<>]+)(~=|>=|<=|=)(.*)$', filterstr[pos + 1:end], re.S)
+        if not m:
+            raise ValueError('Invalid filter item: {0}'.format(filterstr[pos:end + 1]))
+        attr, op, value = m.group(1).strip(), m.group(2), m.group(3)
+
+        if op == '=' and value == '*':
+            return lambda e: bool(_values(e, attr)), end + 1
+        if op in ('>=', '<='):
+            match = _ordering(op, _unescape(value))
+        elif op == '=' and '*' in value:
+            match = _substring([_unescape(p) for p in value.split('*')])
+        else:
+            expected = _unescape(value)
+            match = lambda v: v == expected
+
+        def predicate(entry):
+            for v in _values(entry, attr):
+                if match(v.decode(errors='ignore').lower()):
+                    return True
+            return False
+        return predicate, end + 1
+
+    try:
+        predicate, pos = parse(0)
+    except IndexError:
+        # Ran off the end of a filter with unbalanced parentheses
+        raise ValueError('Invalid filter: {0}'.format(filterstr))
+    if pos != len(filterstr):
+        raise ValueError('Invalid filter: {0}'.format(filterstr))
+    return predicate
+
+
+class MemoryReplicaStore(object):
+    """Keeps the replica in memory. Entries are stored under a key, which is
+    the entryUUID when synchronizing with syncrepl and the DN otherwise.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._keys_by_dn = {}
+        self._state = {}
+
+    def get(self, dn):
+        key = self._keys_by_dn.get(normalize_dn(dn))
+        return self._entries[key][2] if key is not None else None
+
+    def put(self, key, kind, dn, entry):
+        old = self._entries.get(key)
+        if old is not None:
+            self._keys_by_dn.pop(normalize_dn(old[1]), None)
+        self._entries[key] = (kind, dn, entry)
+        self._keys_by_dn[normalize_dn(dn)] = key
+
+    def delete(self, key):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._keys_by_dn.pop(normalize_dn(old[1]), None)
+
+    def keys(self, kind):
+        return set(k for k, v in self._entries.items() if v[0] == kind)
+
+    def entries(self, kind):
+        for k, v in list(self._entries.items()):
+            if v[0] == kind:
+                yield v[1], v[2]
+
+    def get_state(self, name):
+        return self._state.get(name)
+
+    def set_state(self, name, value):
+        self._state[name] = value
+
+    def commit(self):
+        pass
+
+
+class SqliteReplicaStore(object):
+    """Keeps the replica in an SQLite database at ``path`` so that it
+    survives restarts and can be shared by several processes on one host.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, kind TEXT, dn TEXT UNIQUE, data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS entries_kind ON entries (kind);
+            CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT);
+        ''')
+
+    def _dump(self, entry):
+        return json.dumps(dict(
+            (k, [v.decode('utf-8', 'surrogateescape') for v in vals])
+            for k, vals in entry.items()
+        ))
+
+    def _load(self, data):
+        return dict(
+            (k, [v.encode('utf-8', 'surrogateescape') for v in vals])
+            for k, vals in json.loads(data).items()
+        )
+
+    def get(self, dn):
+        row = self.db.execute(
+            'SELECT data FROM entries WHERE dn = ?', (normalize_dn(dn),)
+        ).fetchone()
+        return self._load(row[0]) if row else None
+
+    def put(self, key, kind, dn, entry):
+        self.db.execute('DELETE FROM entries WHERE dn = ? AND key != ?', (normalize_dn(dn), key))
+        self.db.execute(
+            'INSERT OR REPLACE INTO entries (key, kind, dn, data) VALUES (?, ?, ?, ?)',
+            (key, kind, normalize_dn(dn), self._dump(entry))
+        )
+
+    def delete(self, key):
+        self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def keys(self, kind):
+        return set(r[0] for r in self.db.execute('SELECT key FROM entries WHERE kind = ?', (kind,)))
+
+    def entries(self, kind):
+        for dn, data in self.db.execute('SELECT dn, data FROM entries WHERE kind = ?', (kind,)):
+            yield dn, self._load(data)
+
+    def get_state(self, name):
+        row = self.db.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_state(self, name, value):
+        self.db.execute(
+            'INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)', (name, json.dumps(value))
+        )
+
+    def commit(self):
+        self.db.commit()
+
+
+class LdapReplica(object):
+    """A local replica of the user and group OUs of ``client``, which must be
+    an ``LdapClient``. Call ``refresh`` to perform the initial load and
+    periodically afterwards to pull in changes. ``store`` defaults to a
+    ``MemoryReplicaStore``. ``use_syncrepl`` defaults to detecting support
+    for RFC 4533 from the server's root DSE.
+
+    The lookup methods mirror those of ``LdapClient``, for example::
+
+        replica = LdapReplica(client, SqliteReplicaStore('/var/cache/ldap.db'))
+        replica.refresh()
+        replica.search_user('jdoe')
+    """
+    def __init__(self, client, store=None, use_syncrepl=None, detect_deletes=True):
+        self.client = client
+        self.store = store if store is not None else MemoryReplicaStore()
+        self.use_syncrepl = use_syncrepl
+        self.detect_deletes = detect_deletes
+        self._lock = threading.RLock()
+
+    @property
+    def bases(self):
+        return {
+            'user': 'ou={0},{1}'.format(self.client.user_ou, self.client.base),
+            'group': 'ou={0},{1}'.format(self.client.group_ou, self.client.base),
+        }
+
+    def supports_syncrepl(self):
+        result = self.client.conn.search_s(
+            '', ldap.SCOPE_BASE, '(objectClass=*)', ['supportedControl']
+        )
+        controls = result[0][1].get('supportedControl', []) if result else []
+        return SYNCREPL_OID.encode() in controls
+
+    def refresh(self):
+        """Brings the replica up to date with the server."""
+        with self._lock:
+            if self.use_syncrepl is None:
+                self.use_syncrepl = self.supports_syncrepl()
+            for kind, base in self.bases.items():
+                if self.use_syncrepl:
+                    self._sync(kind, base)
+                else:
+                    self._delta(kind, base)
+            self.store.commit()
+
+    def _sync(self, kind, base):
+        cookie = self.store.get_state('cookie:' + kind)
+        try:
+            self._sync_once(kind, base, cookie)
+        except ldap.LDAPError as e:
+            info = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+            if cookie is None or info.get('result') != E_SYNC_REFRESH_REQUIRED:
+                raise
+            self._sync_once(kind, base, None)
+
+    def _sync_once(self, kind, base, cookie):
+        """Performs a refreshOnly synchronization, following the handling of
+        ``ldap.syncrepl.SyncreplConsumer``.
+        """
+        conn = self.client.conn
+        msgid = conn.search_ext(
+            base, ldap.SCOPE_SUBTREE, '(objectClass=*)', attrlist=['*'],
+            serverctrls=[SyncRequestControl(mode='refreshOnly', cookie=cookie)]
+        )
+        seen, deletes_sent = set(), False
+        while True:
+            rtype, rdata, rmsgid, rctrls, respoid, respvalue = conn.result4(
+                msgid, all=0, add_ctrls=1, add_intermediates=1
+            )
+            if rtype == ldap.RES_SEARCH_RESULT:
+                for c in rctrls:
+                    if isinstance(c, SyncDoneControl):
+                        deletes_sent = deletes_sent or c.refreshDeletes
+                        if c.cookie is not None:
+                            cookie = c.cookie
+                break
+
+            if rtype == ldap.RES_SEARCH_ENTRY:
+                for dn, entry, ctrls in rdata:
+                    for c in ctrls:
+                        if not isinstance(c, SyncStateControl):
+                            continue
+                        if c.state == 'delete':
+                            self.store.delete(c.entryUUID)
+                        else:
+                            if c.state != 'present':
+                                self.store.put(c.entryUUID, kind, dn, entry)
+                            seen.add(c.entryUUID)
+                        if c.cookie is not None:
+                            cookie = c.cookie
+
+            elif rtype == ldap.RES_INTERMEDIATE:
+                for rname, resp, ctrls in rdata:
+                    if rname != SyncInfoMessage.responseName:
+                        continue
+                    sim = SyncInfoMessage(resp)
+                    if sim.newcookie is not None:
+                        cookie = sim.newcookie
+                    elif sim.syncIdSet is not None:
+                        if sim.syncIdSet['refreshDeletes']:
+                            for uuid in sim.syncIdSet['syncUUIDs']:
+                                self.store.delete(uuid)
+                        else:
+                            seen.update(sim.syncIdSet['syncUUIDs'])
+                        if sim.syncIdSet['cookie'] is not None:
+                            cookie = sim.syncIdSet['cookie']
+                    else:
+                        phase = sim.refreshPresent or sim.refreshDelete
+                        if sim.refreshDelete is not None:
+                            deletes_sent = True
+                        if phase and phase['cookie'] is not None:
+                            cookie = phase['cookie']
+
+        if not deletes_sent:
+            # Present phase: anything the server didn't mention is gone
+            for key in self.store.keys(kind) - seen:
+                self.store.delete(key)
+        self.store.set_state('cookie:' + kind, cookie)
+
+    def _delta(self, kind, base):
+        since = self.store.get_state('timestamp:' + kind)
+        filterstr = '(objectClass=*)'
+        if since:
+            filterstr = '(modifyTimestamp>={0})'.format(since)
+
+        latest = since
+        found = set()
+        for dn, entry in self.client._search_paged_raw(base, filterstr, ['*', 'modifyTimestamp']):
+            self.store.put(normalize_dn(dn), kind, dn, entry)
+            found.add(normalize_dn(dn))
+            for ts in _values(entry, 'modifyTimestamp'):
+                ts = ts.decode()
+                if latest is None or ts > latest:
+                    latest = ts
+
+        if not since or self.detect_deletes:
+            if since:
+                # A DN-only pass is the only way to notice deletions here
+                found = set(normalize_dn(dn) for dn, e in self.client._search_paged_raw(
+                    base, '(objectClass=*)', ['1.1']
+                ))
+            for key in self.store.keys(kind) - found:
+                self.store.delete(key)
+        self.store.set_state('timestamp:' + kind, latest)
+
+    def _decode(self, entry, attrs=None):
+        if attrs:
+            wanted = set(a.lower() for a in attrs)
+            entry = dict((k, v) for k, v in entry.items() if k.lower() in wanted)
+        return self.client._decode_entry(entry)
+
+    def _iter(self, kind, filterstr, attrs):
+        predicate = compile_filter(filterstr)
+        for dn, entry in self.store.entries(kind):
+            if predicate(entry):
+                yield self._decode(entry, attrs)
+
+    def search_user(self, username):
+        entry = self.store.get(self.client.get_user_string(username))
+        return self._decode(entry) if entry is not None else None
+
+    def search_group(self, groupname):
+        entry = self.store.get(self.client.get_group_string(groupname))
+        return self._decode(entry) if entry is not None else None
+
+    def iter_users(self, filterstr='(objectClass=*)', attrs=None, page_size=None):
+        return self._iter('user', filterstr, attrs)
+
+    def iter_groups(self, filterstr='(objectClass=*)', attrs=None, page_size=None):
+        return self._iter('group', filterstr, attrs)
+
+    def search_users(self, filterstr='(objectClass=*)', attrs=None):
+        return list(self.iter_users(filterstr=filterstr, attrs=attrs))
+
+    def search_groups(self, filterstr='(objectClass=*)', attrs=None):
+        return list(self.iter_groups(filterstr=filterstr, attrs=attrs))
+
+    def next_user_uid(self, filterstr='(objectClass=posixAccount)'):
+        return 1 + max(map(
+            lambda r: r.get_int('uidNumber'),
+            self.iter_users(filterstr=filterstr, attrs=['uidNumber'])
+        ))
+
+    def next_group_gid(self):
+        return 1 + max(map(
+            lambda r: r.get_int('gidNumber'),
+            self.iter_groups(filterstr='(objectClass=posixGroup)', attrs=['gidNumber'])
+        ))
+
+    def groups_for_user(self, username):
+        return [g.first('cn') for g in self.iter_groups(
+            filterstr='(&(objectClass=posixGroup)(memberUid={0}))'.format(
+                escape_filter_chars(username)
+            ),
+            attrs=['cn']
+        )]
+
+    def members_of(self, groupname):
+        group = self.store.get(self.client.get_group_string(groupname))
+        return self._decode(group, ['memberUid']).get('memberUid', []) if group else None
+
+    def membership_index(self, page_size=None):
+        index = collections.defaultdict(set)
+        for group in self.iter_groups('(objectClass=posixGroup)', attrs=['cn', 'memberUid']):
+            name = sys.intern(group.first('cn'))
+            for member in group.get('memberUid', []):
+                index[sys.intern(member)].add(name)
+        return dict((k, frozenset(v)) for k, v in index.items())
@@ -0,0 +1,140 @@
+"""
+    admin_toolbelt.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides a small, thread-safe, in-process registry of
+    counters and latency histograms, along with a dump of its contents in the
+    Prometheus text exposition format.
+"""
+import bisect
+import threading
+
+__all__ = [
+    'DEFAULT_BUCKETS',
+    'Histogram',
+    'MetricsRegistry',
+]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(labels):
+    if isinstance(labels, dict):
+        return tuple(sorted(labels.items()))
+    return tuple(labels)
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v)
+        .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    ) for k, v in items) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    """Counts observations into buckets with the given upper bounds."""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns a list of ``(upper_bound, count)``, ending with +Inf."""
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry(object):
+    """A collection of named counters and histograms, each of which may be
+    split by a set of labels given as a dict or a tuple of ``(name, value)``
+    pairs. For example::
+
+        registry = MetricsRegistry()
+        registry.inc('jobs_total', {'queue': 'default'})
+        registry.observe('job_seconds', 0.25, {'queue': 'default'})
+        print(registry.expose())
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def counter(self, name, labels=()):
+        return self._counters.get((name, _labels(labels)), 0)
+
+    def histogram(self, name, labels=()):
+        return self._histograms.get((name, _labels(labels)))
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def expose(self):
+        """Returns the contents of the registry in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (k, (h.cumulative(), h.sum, h.count)) for k, h in self._histograms.items()
+            )
+
+        last = None
+        for (name, labels), value in counters:
+            if name != last:
+                if name in self._help:
+                    lines.append('# HELP {0} {1}'.format(name, self._help[name]))
+                lines.append('# TYPE {0} counter'.format(name))
+                last = name
+            lines.append('{0}{1} {2}'.format(name, _format_labels(labels), _format_value(value)))
+
+        for (name, labels), (buckets, total, count) in histograms:
+            if name != last:
+                if name in self._help:
+                    lines.append('# HELP {0} {1}'.format(name, self._help[name]))
+                lines.append('# TYPE {0} histogram'.format(name))
+                last = name
+            for bound, cumulative in buckets:
+                le = '+Inf' if bound == float('inf') else _format_value(float(bound))
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _format_labels(labels, [('le', le)]), cumulative
+                ))
+            lines.append('{0}_sum{1} {2}'.format(name, _format_labels(labels), repr(total)))
+            lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
@@ -8,81 +8,207 @@
 """
 
 import collections
-import datetime
+import concurrent.futures
+import errno
+import functools
+import grp
+import logging
 import os
+import pwd
 import shutil
-import logging
-
-from ..utils import run_cmd
 
+from .accounting import AGE_BUCKETS, Usage, UsageAccounting, UsageTable
 from .mounts import get_mount_info
-from .quotas import FilesystemQuota, LustreQuota, XfsQuota, ZfsQuota
+from .quotas import (FilesystemQuota, LustreQuota, QuotaResult, XfsQuota, ZfsQuota,
+                     apply_quotas, query_quotas, quota_class)
+from .purge import PurgeEngine, PurgeSummary
+from .shards import ShardedScanResult, ShardResult, scan_shard
+from .snapshots import QuotaSnapshotStore
+from .walk import (SCAN_BACKENDS, LfsFindBackend, PythonScanBackend, UnusedPeriodPolicy,
+                   scan_dirs, select_backend, visit_dirs)
 
 __all__ = [
+    'AGE_BUCKETS',
     'FilesystemQuota',
     'LustreQuota',
+    'PurgeEngine',
+    'PurgeSummary',
+    'QuotaResult',
+    'QuotaSnapshotStore',
     'XfsQuota',
     'ZfsQuota',
+    'apply_quotas',
+    'query_quotas',
+    'quota_class',
     'get_mount_info',
+    'PathResult',
     'create_path',
+    'create_paths',
+    'LfsFindBackend',
+    'PythonScanBackend',
+    'SCAN_BACKENDS',
+    'ShardResult',
+    'ShardedScanResult',
     'UnusedPeriodPolicy',
-    'visit_dirs'
+    'Usage',
+    'UsageAccounting',
+    'UsageTable',
+    'scan_dirs',
+    'scan_shard',
+    'select_backend',
+    'visit_dirs',
 ]
 
-def create_path(path, owner, group, mode=0o700, copy_files=[], usage_quota=None, inode_quota=None):
-    """Creates a directory with the given attributes if it doesn't exist."""
-    logging.info(('create_path(' + 
-        'path={}, owner={}, group={}, mode={}, copy_files={}, usage_quota={}, inode_quota={}' + 
-        ')').format(path, owner, group, mode, copy_files, usage_quota, inode_quota)
-    )
-    if not os.path.exists(path):
-        logging.info('%s: Path does not exist, creating...', path)
-        mnt = get_mount_info(path)
-        os.mkdir(path)
+logger = logging.getLogger(__name__)
+
+PathResult = collections.namedtuple('PathResult', 'path status error quota')
 
-        for src, dest in copy_files:
-            shutil.copyfile(src, os.path.join(path, dest))
 
-        run_cmd('chown -R {0}:{1} {2}'.format(owner, group, path))
-        os.chmod(path, mode)
-        
-        if usage_quota or inode_quota:
-            run_cmd(set_quota_cmd(
-                owner, mnt.file, fstype=mnt.vfstype, usage=usage_quota, inode=inode_quota
-            ))
+@functools.lru_cache(maxsize=None)
+def _uid(owner):
+    if isinstance(owner, int) or str(owner).isdigit():
+        return int(owner)
+    return pwd.getpwnam(owner).pw_uid
 
-        logging.info('... done.')
+
+@functools.lru_cache(maxsize=None)
+def _gid(group):
+    if isinstance(group, int) or str(group).isdigit():
+        return int(group)
+    return grp.getgrnam(group).gr_gid
+
+
+def _copy_file_range(infd, outfd, count):
+    return os.copy_file_range(infd, outfd, count)
+
+
+def _sendfile(infd, outfd, count):
+    return os.sendfile(outfd, infd, None, count)
+
+
+_KERNEL_COPIES = [
+    copy for name, copy in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile))
+    if hasattr(os, name)
+]
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
 
 
-class UnusedPeriodPolicy(object):
-    """Instances of this policy return True if the file at the given path
-    hasn't been accessed or modified within the given time period, which 
-    should be an instance of ``datetime.timedelta``.
+def _copy_file(src, dest, uid, gid):
+    """Copies src to dest inside the kernel where possible, using
+    ``copy_file_range`` (which can share extents or copy server-side) or
+    ``sendfile``, falling back to an ordinary copy.
     """
-    def __init__(self, period=datetime.timedelta(days=30)):
-        self.period = period
-
-    def __call__(self, path):
-        cutoff = datetime.datetime.now() - self.period
-        st = os.lstat(path)
-        return (
-            cutoff < datetime.datetime.fromtimestamp(st.st_atime) and
-            cutoff < datetime.datetime.fromtimestamp(st.st_mtime)
-        )
-
-
-def visit_dirs(dirs, policy=UnusedPeriodPolicy(), action=print):
-    """Provided a list of directories, ``dirs``, recursively searches for files 
-    for which the provided policy returns True, and execute the given action on
-    them. ``policy`` and ``action`` should be callable objects accepting a file 
-    path as their only argument. By default, prints the path of all files that 
-    haven't been accessed or modified in over 30 days.
-    
-    For example, to institute a purge of any files in the directories over 30 
-    days old, you could set ``action=os.remove``.
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        infd, outfd = fsrc.fileno(), fdest.fileno()
+        os.fchown(outfd, uid, gid)
+        size = os.fstat(infd).st_size
+        for copy in _KERNEL_COPIES:
+            remaining = size
+            try:
+                while remaining > 0:
+                    n = copy(infd, outfd, remaining)
+                    if n == 0:
+                        break
+                    remaining -= n
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                remaining = -1
+            if remaining == 0:
+                return
+            # Start over with the next method, in case this one copied part
+            os.lseek(infd, 0, os.SEEK_SET)
+            os.lseek(outfd, 0, os.SEEK_SET)
+            os.ftruncate(outfd, 0)
+        shutil.copyfileobj(fsrc, fdest)
+
+
+def _create_one(spec):
+    path = spec['path']
+    uid, gid = _uid(spec['owner']), _gid(spec['group'])
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        return 'exists'
+    for src, dest in spec.get('copy_files', ()):
+        _copy_file(src, os.path.join(path, dest), uid, gid)
+    os.chown(path, uid, gid)
+    os.chmod(path, spec.get('mode', 0o700))
+    return 'created'
+
+
+def create_paths(specs, workers=8, quota_workers=4, quota_existing=False):
+    """Creates many directories, each described by a dict of the arguments
+    to ``create_path``, using up to ``workers`` threads. Ownership is set
+    and skeleton files are copied in-process, and the mount of each parent
+    directory is resolved once.
+
+    Once every directory has been created, the quotas requested for new
+    directories are applied with ``apply_quotas``, so that each filesystem
+    receives a handful of batched commands instead of one per directory.
+    With ``quota_existing`` set, quotas are also applied to directories
+    which already existed, so that retries complete an earlier attempt.
+
+    Returns a list of ``PathResult(path, status, error, quota)`` in input
+    order, where status is one of ``'created'``, ``'exists'`` or
+    ``'failed'``, and quota is the ``QuotaResult`` for the path, if any.
     """
-    for dname in dirs:
-        for path, subdirs, files in os.walk(dname):
-            for fname in files:
-                if policy(os.path.join(path,fname)):
-                    action(os.path.join(path,fname))
+    specs = list(specs)
+    mounts = {}
+    for spec in specs:
+        parent = os.path.dirname(os.path.abspath(spec['path']))
+        if parent not in mounts:
+            try:
+                mounts[parent] = get_mount_info(parent)
+            except OSError:
+                mounts[parent] = None
+
+    def create(spec):
+        try:
+            return _create_one(spec), None
+        except Exception as e:
+            logger.warning('Unable to create %s: %s', spec['path'], e)
+            return 'failed', e
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        outcomes = list(pool.map(create, specs))
+
+    quotas = {}
+    for i, (spec, (status, error)) in enumerate(zip(specs, outcomes)):
+        usage, inode = spec.get('usage_quota'), spec.get('inode_quota')
+        wanted = status == 'created' or (status == 'exists' and quota_existing)
+        if not wanted or not (usage or inode):
+            continue
+        mnt = mounts[os.path.dirname(os.path.abspath(spec['path']))]
+        cls = quota_class(mnt.vfstype) if mnt is not None else None
+        if cls is None:
+            outcomes[i] = ('failed', OSError('Quotas are not supported on {0}'.format(
+                mnt.vfstype if mnt is not None else spec['path']
+            )))
+            continue
+        quotas[i] = cls(cls.filesystem_name(mnt), spec['owner'],
+            block_hard=str(usage or 0), inode_hard=str(inode or 0))
+
+    applied = dict(zip(quotas, apply_quotas(quotas.values(), max_workers=quota_workers)))
+    results = []
+    for i, (spec, (status, error)) in enumerate(zip(specs, outcomes)):
+        quota = applied.get(i)
+        if quota is not None and quota.status == 'failed':
+            status, error = 'failed', quota.error
+        results.append(PathResult(spec['path'], status, error, quota))
+    return results
+
+
+def create_path(path, owner, group, mode=0o700, copy_files=[], usage_quota=None, inode_quota=None):
+    """Creates a directory with the given attributes if it doesn't exist."""
+    logger.info(('create_path(' + 
+        'path={}, owner={}, group={}, mode={}, copy_files={}, usage_quota={}, inode_quota={}' + 
+        ')').format(path, owner, group, mode, copy_files, usage_quota, inode_quota)
+    )
+    result = create_paths([dict(
+        path=path, owner=owner, group=group, mode=mode, copy_files=copy_files,
+        usage_quota=usage_quota, inode_quota=inode_quota
+    )], workers=1)[0]
+    if result.error is not None:
+        raise result.error
+    logger.info('%s: %s', path, result.status)
@@ -0,0 +1,196 @@
+"""
+    admin_toolbelt.storage.accounting
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides usage accounting for filesystems which don't enforce
+    quotas. A single walk of the tree totals the space, file counts and
+    access and modification ages of files per owner and per top-level
+    directory, and partial results from directories scanned separately can
+    be merged together.
+"""
+import array
+import bisect
+import collections
+import heapq
+import os
+import time
+
+from .quotas import FilesystemQuota
+from .walk import scan_dirs
+
+__all__ = [
+    'AGE_BUCKETS',
+    'Usage',
+    'UsageAccounting',
+    'UsageTable',
+]
+
+# Upper bounds in days of each age histogram bucket, the last bucket holds
+# everything older
+AGE_BUCKETS = (1, 7, 30, 90, 180, 365, 730)
+
+Usage = collections.namedtuple('Usage', 'bytes blocks files atime_ages mtime_ages')
+
+
+class UsageTable(object):
+    """Per-key totals of apparent size, allocated 512-byte blocks, file count
+    and atime and mtime age histograms. Every key's counters occupy a fixed
+    number of slots in a single flat array of 64-bit integers, so memory
+    grows only with the number of keys.
+    """
+    def __init__(self, buckets=AGE_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.stride = 3 + 2 * (len(self.buckets) + 1)
+        self._offsets = {}
+        self._data = array.array('q')
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def _offset(self, key):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._offsets[key] = len(self._data)
+            self._data.extend([0] * self.stride)
+        return offset
+
+    def add(self, key, size, blocks, atime_bucket, mtime_bucket):
+        offset = self._offset(key)
+        data = self._data
+        data[offset] += size
+        data[offset + 1] += blocks
+        data[offset + 2] += 1
+        data[offset + 3 + atime_bucket] += 1
+        data[offset + 4 + len(self.buckets) + mtime_bucket] += 1
+
+    def values(self, key):
+        """Returns the raw counters of key as a list."""
+        offset = self._offsets[key]
+        return self._data[offset:offset + self.stride].tolist()
+
+    def __getitem__(self, key):
+        values = self.values(key)
+        n = len(self.buckets) + 1
+        return Usage(values[0], values[1], values[2], values[3:3 + n], values[3 + n:])
+
+    def items(self):
+        for key in self._offsets:
+            yield key, self[key]
+
+    def merge(self, other):
+        """Adds the totals of another table with the same buckets to this one."""
+        if other.buckets != self.buckets:
+            raise ValueError('Unable to merge tables with different age buckets')
+        data = self._data
+        for key in other:
+            offset = self._offset(key)
+            for i, value in enumerate(other.values(key)):
+                data[offset + i] += value
+        return self
+
+    def state(self):
+        """Returns a JSON-serializable copy of the table."""
+        return [[key, self.values(key)] for key in self._offsets]
+
+    @classmethod
+    def from_state(cls, state, buckets=AGE_BUCKETS):
+        table = cls(buckets)
+        for key, values in state:
+            offset = table._offset(key)
+            table._data[offset:offset + table.stride] = array.array('q', values)
+        return table
+
+
+class UsageAccounting(object):
+    """Totals the usage of every file under a set of directories by owner
+    (``by_uid``) and by top-level directory (``by_dir``) in a single walk.
+    Ages are measured from ``now`` and counted into ``buckets``.
+
+    Hard links are counted once per link, as keeping track of the inodes
+    already seen would not fit the bounded memory this is designed for.
+
+    For example, to find who uses the most space on an export::
+
+        accounting = UsageAccounting()
+        accounting.scan(['/export/home'], workers=8)
+        for uid, usage in accounting.top_owners(10):
+            print(uid, usage.bytes, usage.files)
+    """
+    def __init__(self, now=None, buckets=AGE_BUCKETS):
+        self.now = time.time() if now is None else now
+        self.buckets = tuple(buckets)
+        self.by_uid = UsageTable(self.buckets)
+        self.by_dir = UsageTable(self.buckets)
+
+    def _bucket(self, timestamp):
+        return bisect.bisect_right(self.buckets, (self.now - timestamp) / 86400.0)
+
+    def add(self, st, directory):
+        """Counts a single ``os.stat_result`` against its owner and directory."""
+        atime, mtime = self._bucket(st.st_atime), self._bucket(st.st_mtime)
+        blocks = getattr(st, 'st_blocks', 0)
+        self.by_uid.add(st.st_uid, st.st_size, blocks, atime, mtime)
+        self.by_dir.add(directory, st.st_size, blocks, atime, mtime)
+
+    def scan(self, dirs, workers=1):
+        """Walks each directory in dirs with ``scan_dirs``, counting every
+        file which isn't a directory. Files directly inside one of the dirs
+        are counted against the directory itself.
+        """
+        for root in dirs:
+            root = os.path.abspath(root)
+            prefix = len(root.rstrip(os.sep)) + 1
+            for entry in scan_dirs([root], workers=workers):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                top, sep, _ = entry.path[prefix:].partition(os.sep)
+                self.add(st, os.path.join(root, top) if sep else root)
+        return self
+
+    def merge(self, other):
+        """Adds the totals of another ``UsageAccounting``, such as one from a
+        shard scanned in parallel, to this one.
+        """
+        self.by_uid.merge(other.by_uid)
+        self.by_dir.merge(other.by_dir)
+        return self
+
+    def state(self):
+        """Returns a JSON-serializable copy of the totals."""
+        return {
+            'now': self.now,
+            'buckets': list(self.buckets),
+            'by_uid': self.by_uid.state(),
+            'by_dir': self.by_dir.state(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        accounting = cls(now=state['now'], buckets=state['buckets'])
+        accounting.by_uid = UsageTable.from_state(state['by_uid'], accounting.buckets)
+        accounting.by_dir = UsageTable.from_state(state['by_dir'], accounting.buckets)
+        return accounting
+
+    def top_owners(self, n=10, field='bytes'):
+        """Returns the n ``(uid, Usage)`` pairs with the largest field."""
+        return heapq.nlargest(n, self.by_uid.items(), key=lambda item: getattr(item[1], field))
+
+    def quotas(self, fsname, cls=FilesystemQuota):
+        """Returns a dict mapping each uid to a cls instance whose usage is
+        populated like those returned by ``FilesystemQuota.report``, with
+        block usage in 1K blocks and no limits.
+        """
+        result = {}
+        for uid, usage in self.by_uid.items():
+            quota = cls(fsname, str(uid))
+            quota._set_usage((str(usage.blocks // 2), '0', '0', str(usage.files), '0', '0'))
+            result[str(uid)] = quota
+        return result
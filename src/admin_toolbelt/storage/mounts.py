@@ -3,25 +3,174 @@
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     This module primarily provides a mechanism for getting information on the
-    filesystem on which a given path resides. 
+    filesystem on which a given path resides.
+
+    The mount table is read from ``/proc/self/mountinfo`` on first use and
+    indexed by mount point, and is reloaded whenever the kernel reports that
+    the table has changed, so that long running processes see mounts which
+    appear later, such as those made by autofs.
 """
 import collections
 import os
+import re
+import select
+import threading
+import time
+
+__all__ = [
+    'Mount',
+    'MountTable',
+    'get_mount_info',
+    'mount_table',
+    'parse_mountinfo',
+    'parse_mounts',
+]
 
 Mount = collections.namedtuple("Mount", "spec file vfstype mntops freq passno")
-mount_info = [Mount(*line.split()) for line in open("/proc/mounts").readlines()]
+
+_OCTAL_ESCAPE = re.compile(br'\\([0-7]{3})')
+
+
+def _unescape(field):
+    """Decodes the octal escapes the kernel uses for spaces, tabs,
+    newlines and backslashes in mount table fields.
+    """
+    return os.fsdecode(_OCTAL_ESCAPE.sub(lambda m: bytes((int(m.group(1), 8),)), field))
+
+
+def parse_mountinfo(data):
+    """Returns the list of ``Mount`` described by the contents of a
+    ``/proc/<pid>/mountinfo`` file, given as bytes. Mountinfo has no dump
+    frequency or pass number, so those are always ``'0'``.
+    """
+    mounts = []
+    for line in data.splitlines():
+        fields = line.split()
+        try:
+            sep = fields.index(b'-', 6)
+        except ValueError:
+            continue
+        options = fields[5].split(b',')
+        options += [o for o in fields[sep + 3].split(b',') if o not in options]
+        mounts.append(Mount(
+            _unescape(fields[sep + 2]), _unescape(fields[4]), _unescape(fields[sep + 1]),
+            _unescape(b','.join(options)), '0', '0'
+        ))
+    return mounts
+
+
+def parse_mounts(data):
+    """Returns the list of ``Mount`` described by the contents of a
+    ``/proc/mounts`` or ``/etc/fstab`` style file, given as bytes.
+    """
+    mounts = []
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) == 6 and not fields[0].startswith(b'#'):
+            mounts.append(Mount(*(_unescape(f) for f in fields)))
+    return mounts
+
+
+class MountTable(object):
+    """An index of the mount table keyed by mount point. Nothing is read
+    until the first lookup.
+
+    Changes are detected by polling ``watch_path``, which the kernel flags
+    with ``POLLPRI`` whenever a filesystem is mounted or unmounted, so
+    checking for them costs one non-blocking system call. If the file can't
+    be polled, the table is instead reloaded once it is ``max_age`` seconds
+    old.
+    """
+    def __init__(self, path='/proc/self/mountinfo', watch_path='/proc/self/mounts',
+            max_age=30, memo_size=4096):
+        self.path, self.watch_path = path, watch_path
+        self.max_age, self.memo_size = max_age, memo_size
+        self._index = None
+        self._memo = {}
+        self._loaded = 0
+        self._watch = None
+        self._poll = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return parse_mountinfo(f.read())
+        except IOError:
+            with open('/proc/mounts', 'rb') as f:
+                return parse_mounts(f.read())
+
+    def _start_watch(self):
+        try:
+            self._watch = open(self.watch_path, 'rb')
+            self._poll = select.poll()
+            self._poll.register(self._watch, select.POLLPRI | select.POLLERR)
+        except (IOError, AttributeError):
+            self._watch = self._poll = None
+
+    def _changed(self):
+        if self._poll is not None:
+            return bool(self._poll.poll(0))
+        return self.max_age is not None and time.monotonic() - self._loaded > self.max_age
+
+    def refresh(self, force=False):
+        """Reloads the table if it was never loaded, has changed, or if
+        ``force`` is set. Returns True if it was reloaded.
+        """
+        if not force and self._index is not None and not self._changed():
+            return False
+        with self._lock:
+            if self._watch is None:
+                self._start_watch()
+            index = {}
+            for mnt in self._read():
+                # Later entries are stacked on top of earlier ones
+                index[mnt.file] = mnt
+            self._index, self._memo = index, {}
+            self._loaded = time.monotonic()
+        return True
+
+    def mounts(self):
+        """Returns the list of mounts, one per mount point."""
+        self.refresh()
+        return list(self._index.values())
+
+    def __getitem__(self, mount_point):
+        self.refresh()
+        return self._index[mount_point]
+
+    def _containing(self, path):
+        index = self._index
+        while True:
+            if path in index:
+                return index[path]
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise OSError("Invalid path")
+            path = parent
+
+    def lookup(self, path):
+        """Returns the mount of the filesystem on which path resides."""
+        self.refresh()
+        path = os.path.realpath(os.path.abspath(path))
+        index, memo = self._index, self._memo
+        if path in index:
+            return index[path]
+        # Everything in a directory which isn't a mount point itself shares
+        # the directory's filesystem, so memoize on the parent
+        parent = os.path.dirname(path)
+        mnt = memo.get(parent)
+        if mnt is None:
+            mnt = self._containing(parent)
+            if len(memo) >= self.memo_size:
+                memo.clear()
+            memo[parent] = mnt
+        return mnt
+
+
+mount_table = MountTable()
 
 
 def get_mount_info(path):
     """Returns the mount info of the filesystem on which the given path exists."""
-    path = os.path.realpath(os.path.abspath(path))
-    while True:
-        for mnt in mount_info:
-            if path == mnt.file:
-                return mnt
-        next = os.path.abspath(os.path.join(path, os.pardir))
-        if next == path:
-            break
-        path = next
-
-    raise OSError("Invalid path")
+    return mount_table.lookup(path)
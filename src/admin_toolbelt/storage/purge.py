@@ -0,0 +1,269 @@
+"""
+    admin_toolbelt.storage.purge
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides a purge engine for removing files which match a
+    policy, such as ``UnusedPeriodPolicy``, from large shared filesystems.
+    Unlinks are throttled and batched onto a small pool of threads, and every
+    candidate and deletion is written to an append-only journal along with
+    periodic checkpoints of the walk position, so that an interrupted purge
+    can be resumed without rescanning the directories it already finished.
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import time
+
+from ..utils import RateLimiter
+from .walk import UnusedPeriodPolicy, _matches
+
+__all__ = [
+    'PurgeEngine',
+    'PurgeSummary',
+]
+
+logger = logging.getLogger(__name__)
+
+_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'))
+
+
+def _escape(value):
+    for char, escaped in _ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+def _unescape(value):
+    result, chars = [], iter(value)
+    for char in chars:
+        if char == '\\':
+            char = {'t': '\t', 'n': '\n'}.get(next(chars, ''), '\\')
+        result.append(char)
+    return ''.join(result)
+
+
+class PurgeSummary(object):
+    """Totals for a single purge run. ``files_by_owner`` and
+    ``bytes_by_owner`` count the candidates found for each uid, whether or
+    not they were deleted.
+    """
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.files_by_owner = collections.Counter()
+        self.bytes_by_owner = collections.Counter()
+        self.deleted = 0
+        self.failed = 0
+        self.resumed_from = None
+
+    @property
+    def files(self):
+        return sum(self.files_by_owner.values())
+
+    @property
+    def bytes(self):
+        return sum(self.bytes_by_owner.values())
+
+    def add(self, uid, size):
+        self.files_by_owner[uid] += 1
+        self.bytes_by_owner[uid] += size
+
+    def __repr__(self):
+        return '<PurgeSummary dry_run={0} files={1} bytes={2} deleted={3} failed={4}>'.format(
+            self.dry_run, self.files, self.bytes, self.deleted, self.failed
+        )
+
+
+class PurgeEngine(object):
+    """Walks ``dirs`` in sorted order and removes every file for which
+    ``policy`` returns True. With ``dry_run`` set, which is the default,
+    nothing is removed and the returned ``PurgeSummary`` only reports what
+    would have been.
+
+    Unlinks are made in batches of ``batch_size`` on a pool of
+    ``max_in_flight`` threads, no more than ``rate`` per second if given.
+
+    If ``journal`` is a path, a line is appended to it for each run start
+    (``S``), candidate (``C``), deletion (``D``) and failure (``E``), and a
+    checkpoint (``K``) is written after every ``checkpoint_every``
+    directories once all of the deletions before it have completed. If the
+    last run in the journal never finished (``F``), ``run`` picks up after
+    its last checkpoint; the summary then only covers the remainder.
+
+    For example, to remove files unused for 90 days at no more than 500
+    unlinks per second::
+
+        engine = PurgeEngine(['/scratch'], UnusedPeriodPolicy(timedelta(days=90)),
+                             journal='/var/log/purge/scratch.journal',
+                             dry_run=False, rate=500)
+        engine.run()
+    """
+    def __init__(self, dirs, policy=UnusedPeriodPolicy(), journal=None, dry_run=True,
+            rate=None, max_in_flight=4, batch_size=100, checkpoint_every=100):
+        self.dirs = list(dirs)
+        self.policy = policy
+        self.journal = journal
+        self.dry_run = dry_run
+        self.limiter = RateLimiter(rate, burst=batch_size) if rate else None
+        self.max_in_flight = max(1, max_in_flight)
+        self.batch_size = max(1, batch_size)
+        self.checkpoint_every = max(1, checkpoint_every)
+        self._journal = None
+
+    def checkpoint(self):
+        """Returns the ``(dir_index, relative_parts)`` position to resume
+        from, or None if the journal has no unfinished run in the same mode.
+        """
+        if not self.journal or not os.path.exists(self.journal):
+            return None
+        running, position = False, None
+        with open(self.journal, encoding='utf-8', errors='surrogateescape') as f:
+            for line in f:
+                fields = [_unescape(field) for field in line.rstrip('\n').split('\t')]
+                if fields[0] == 'S':
+                    running, position = fields[2:3] == [self._mode], (0, None)
+                elif fields[0] == 'F':
+                    running, position = False, None
+                elif fields[0] == 'K' and running:
+                    parts = tuple(fields[2].split('/')) if fields[2] else ()
+                    position = (int(fields[1]), parts)
+        return position if running else None
+
+    @property
+    def _mode(self):
+        return 'dry-run' if self.dry_run else 'delete'
+
+    def _write(self, *fields):
+        if self._journal is not None:
+            self._journal.write('\t'.join(_escape(str(f)) for f in fields) + '\n')
+
+    def _sync(self):
+        if self._journal is not None:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def _walk(self, checkpoint):
+        """Yields ``(dir_index, relative_parts, entries)`` for each directory
+        in depth-first, name-sorted order, skipping everything at or before
+        the checkpoint. Ordering is what makes a checkpoint a single tuple:
+        a directory's files are done iff its parts compare <= the checkpoint.
+        """
+        start, done = checkpoint or (0, None)
+        for index, root in enumerate(self.dirs):
+            if index < start:
+                continue
+            stack = [(root, ())]
+            while stack:
+                path, parts = stack.pop()
+                try:
+                    with os.scandir(path) as it:
+                        entries = sorted(it, key=lambda e: e.name)
+                except OSError as e:
+                    logger.warning('Unable to list %s: %s', path, e)
+                    continue
+
+                subdirs, matches = [], []
+                skip_files = index == start and done is not None and parts <= done
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub = parts + (entry.name,)
+                            # Skip subtrees which were finished before the checkpoint
+                            if (index == start and done is not None and sub < done
+                                    and done[:len(sub)] != sub):
+                                continue
+                            subdirs.append((entry.path, sub))
+                        elif not skip_files and _matches(self.policy, entry):
+                            matches.append(entry)
+                    except OSError:
+                        continue
+                yield index, parts, matches
+                stack.extend(reversed(subdirs))
+            done = None
+
+    def _unlink(self, paths):
+        results = []
+        for path in paths:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                os.unlink(path)
+                results.append((path, None))
+            except OSError as e:
+                results.append((path, e.strerror or str(e)))
+        return results
+
+    def _collect(self, future, summary):
+        for path, error in future.result():
+            if error is None:
+                summary.deleted += 1
+                self._write('D', path)
+            else:
+                summary.failed += 1
+                self._write('E', path, error)
+                logger.warning('Unable to remove %s: %s', path, error)
+
+    def run(self, resume=True):
+        """Runs the purge, returning a ``PurgeSummary``. Pass ``resume=False``
+        to start over even if the journal records an unfinished run.
+        """
+        summary = PurgeSummary(self.dry_run)
+        checkpoint = self.checkpoint() if resume else None
+        if self.journal:
+            self._journal = open(self.journal, 'a', encoding='utf-8', errors='surrogateescape')
+        if checkpoint is None:
+            self._write('S', int(time.time()), self._mode)
+        else:
+            summary.resumed_from = checkpoint
+            logger.info('Resuming purge after %s', checkpoint)
+
+        pool = None
+        if not self.dry_run:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight)
+        in_flight, batch, visited = collections.deque(), [], 0
+
+        def submit():
+            if batch:
+                while len(in_flight) >= self.max_in_flight:
+                    self._collect(in_flight.popleft(), summary)
+                in_flight.append(pool.submit(self._unlink, list(batch)))
+                del batch[:]
+
+        def drain():
+            submit()
+            while in_flight:
+                self._collect(in_flight.popleft(), summary)
+
+        try:
+            for index, parts, matches in self._walk(checkpoint):
+                for entry in matches:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    summary.add(st.st_uid, st.st_size)
+                    self._write('C', entry.path, st.st_uid, st.st_size)
+                    if pool is not None:
+                        batch.append(entry.path)
+                        if len(batch) >= self.batch_size:
+                            submit()
+
+                visited += 1
+                if visited % self.checkpoint_every == 0:
+                    if pool is not None:
+                        drain()
+                    self._write('K', index, '/'.join(parts))
+                    self._sync()
+
+            if pool is not None:
+                drain()
+            self._write('F', int(time.time()), summary.files, summary.bytes, summary.deleted)
+        finally:
+            if pool is not None:
+                drain()
+                pool.shutdown()
+            if self._journal is not None:
+                self._sync()
+                self._journal.close()
+                self._journal = None
+        return summary
@@ -6,8 +6,45 @@
     filesystems. The classes in this module implement the interface for
     both setting quotas and gathering current usage information.
 """
+import asyncio
+import collections
+import concurrent.futures
+import csv
+import grp
+import logging
+import pwd
+import re
+
+from ..utils import CommandRunner, iter_cmd, run_cmd
+
+__all__ = [
+    'FilesystemQuota',
+    'LustreQuota',
+    'QuotaResult',
+    'XfsQuota',
+    'ZfsQuota',
+    'apply_quotas',
+    'query_quotas',
+    'quota_class',
+]
+
+logger = logging.getLogger(__name__)
+
+QuotaResult = collections.namedtuple('QuotaResult', 'quota status error')
+
+# Shared by the async methods when no runner is given. Quota commands hang
+# along with their filesystem, so they are given a limit by default.
+DEFAULT_TIMEOUT = 300
+_runner = CommandRunner(timeout=DEFAULT_TIMEOUT)
+
+
+def _limit(value):
+    """Normalizes a value from a quota report, where unset limits may be 
+    shown as 'none' or '-' and exceeded values are marked with a '*'.
+    """
+    value = value.rstrip('*')
+    return '0' if value in ('none', '-', '') else value
 
-from ..utils import run_cmd
 
 class FilesystemQuota(object):
     """The base class for filesystem quota management. Supports ext
@@ -19,19 +56,29 @@ class FilesystemQuota(object):
         'user': '-u',
         'group': '-g',
     }
+    limit_fields = ('_bsoft', '_bhard', '_isoft', '_ihard')
+    max_batch = 500
 
     def __init__(self, filesystem, identity, idtype='user', 
             block_soft='0', block_hard='0', inode_soft='0', inode_hard='0'):
-        if idtype not in self.idtype_flags:
-            raise ValueError('Invalid idtype "{0}". Valid values are "{1}"'.format(
-                idtype, ', '.join(idtype_flags.keys())
-            ))
+        self._check_idtype(idtype)
 
         self._queried = False
         self.fsname, self.identity, self.idtype = filesystem, identity, idtype
         self._bsoft, self._bhard, self._bused = block_soft, block_hard, None
         self._isoft, self._ihard, self._iused = inode_soft, inode_hard, None
 
+    @classmethod
+    def _check_idtype(cls, idtype):
+        if idtype not in cls.idtype_flags:
+            raise ValueError('Invalid idtype "{0}". Valid values are "{1}"'.format(
+                idtype, ', '.join(cls.idtype_flags.keys())
+            ))
+
+    def _set_usage(self, values):
+        self._bused, self._bsoft, self._bhard, self._iused, self._isoft, self._ihard = values
+        self._queried = True
+
     def _query_if_needed(self):
         if not self._queried:
             self.query()
@@ -68,7 +115,7 @@ class FilesystemQuota(object):
         return self._ihard
 
     def get_command(self):
-        return '/sbin/quota {1} {2}'.format(self.idtype_flags[self.idtype], self.identity)
+        return '/sbin/quota {0} {1}'.format(self.idtype_flags[self.idtype], self.identity)
 
     def set_command(self):
         return ' '.join([
@@ -88,6 +135,73 @@ class FilesystemQuota(object):
     def apply(self):
         run_cmd(self.set_command())
 
+    async def query_async(self, runner=None):
+        """Like ``query``, but runs the command through a ``CommandRunner``
+        so that many queries can be made concurrently. Without a runner, a
+        shared one is used which kills commands after ``DEFAULT_TIMEOUT``
+        seconds.
+        """
+        result = await (runner or _runner).run(self.get_command())
+        self._bused, self._bsoft, self._bhard, self._iused, self._isoft, self._ihard = self.parse(
+            result.stdout
+        )
+        self._queried = True
+
+    async def apply_async(self, runner=None):
+        """Like ``apply``, but runs the command through a ``CommandRunner``."""
+        await (runner or _runner).run(self.set_command())
+
+    def limits(self):
+        """Returns the limits which ``apply`` sets, normalized for comparison."""
+        return tuple(_limit(str(getattr(self, f))) for f in self.limit_fields)
+
+    @classmethod
+    def batch_set_commands(cls, quotas):
+        """Returns a list of ``(command, stdin, quotas)`` which together apply 
+        the given quotas, all of which share a filesystem and idtype. 
+        ``setquota -b`` reads the limits for every identity from stdin.
+        """
+        return [(
+            '/sbin/setquota -b {0} {1}'.format(cls.idtype_flags[quotas[0].idtype], quotas[0].fsname),
+            ''.join('{0} {1} {2} {3} {4}\n'.format(
+                q.identity, q._bsoft, q._bhard, q._isoft, q._ihard
+            ) for q in quotas),
+            quotas
+        )]
+
+    @classmethod
+    def filesystem_name(cls, mount):
+        """Returns the name used for the filesystem of the given ``Mount``."""
+        return mount.file
+
+    @classmethod
+    def report_command(cls, fsname, idtype='user'):
+        return '/usr/sbin/repquota -O csv -n -p {0} {1}'.format(cls.idtype_flags[idtype], fsname)
+
+    @classmethod
+    def parse_report(cls, lines):
+        """Parses the output of ``report_command``, yielding tuples of
+        ``(identity, (bused, bsoft, bhard, iused, isoft, ihard))``.
+        """
+        for row in csv.reader(lines):
+            if len(row) < 11 or not row[3].isdigit():
+                continue
+            yield row[0].lstrip('#'), (row[3], row[4], row[5], row[7], row[8], row[9])
+
+    @classmethod
+    def report(cls, fsname, idtype='user'):
+        """Gathers usage and limits for every identity of the given type on
+        the filesystem with a single command, returning a dict mapping each
+        identity to an instance whose values are already populated.
+        """
+        cls._check_idtype(idtype)
+        result = {}
+        for identity, values in cls.parse_report(iter_cmd(cls.report_command(fsname, idtype))):
+            quota = cls(fsname, identity, idtype)
+            quota._set_usage(tuple(_limit(v) for v in values))
+            result[identity] = quota
+        return result
+
 
 class LustreQuota(FilesystemQuota):
     supported_filesystems = ['lustre']
@@ -106,6 +220,24 @@ class LustreQuota(FilesystemQuota):
         fsname, bused, bsoft, bhard, btime, iused, isoft, ihard, itime = stdout.split()
         return bused, bsoft, bhard, iused, isoft, ihard
 
+    @classmethod
+    def report_command(cls, fsname, idtype='user'):
+        return '/bin/lfs quota -q -a {0} {1}'.format(cls.idtype_flags[idtype], fsname)
+
+    @classmethod
+    def parse_report(cls, lines):
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 9 or not fields[1].rstrip('*').isdigit():
+                continue
+            identity, bused, bsoft, bhard, btime, iused, isoft, ihard, itime = fields
+            yield identity, (bused, bsoft, bhard, iused, isoft, ihard)
+
+    @classmethod
+    def batch_set_commands(cls, quotas):
+        # lfs setquota only accepts a single identity per invocation
+        return [(q.set_command(), None, [q]) for q in quotas]
+
     def set_command(self):
         return (
             '/bin/lfs setquota {0} {1}' +
@@ -120,26 +252,77 @@ class LustreQuota(FilesystemQuota):
 
     
 class XfsQuota(FilesystemQuota):
+    """Block limits are in bytes, optionally with one of the binary suffixes
+    ``k``, ``m``, ``g``, ``t``, ``p`` or ``e`` accepted by ``xfs_quota``,
+    and those gathered by ``report`` are converted to bytes to match.
+    """
     supported_filesystems = ['xfs']
     idtype_flags = {
         'user': '-u',
         'group': '-g',
         'project': '-p',
     }
+    suffixes = 'kmgtpe'
 
-    def set_command(self):
-        return (
-            "/usr/sbin/xfs_quota -x -c" +
-            " 'limit {0} bsoft={1} bhard={2} isoft={3} ihard={4} {5}' {6}"
-        ).format(
+    @classmethod
+    def report_command(cls, fsname, idtype='user'):
+        return "/usr/sbin/xfs_quota -x -c 'report {0} -n -N -b -i' {1}".format(
+            cls.idtype_flags[idtype], fsname
+        )
+
+    @classmethod
+    def parse_report(cls, lines):
+        for line in lines:
+            # Grace periods are bracketed and may contain spaces, e.g. [7 days]
+            fields = re.sub(r'\[[^\]]*\]', ' ', line).split()
+            if len(fields) != 9 or not fields[1].isdigit():
+                continue
+            identity, bused, bsoft, bhard, bwarn, iused, isoft, ihard, iwarn = fields
+            # -b reports 1KiB blocks, while limit reads plain numbers as bytes
+            bused, bsoft, bhard = [
+                str(int(v.rstrip('*')) * 1024) if v.rstrip('*').isdigit() else v
+                for v in (bused, bsoft, bhard)
+            ]
+            yield identity.lstrip('#'), (bused, bsoft, bhard, iused, isoft, ihard)
+
+    @classmethod
+    def _kib(cls, value):
+        """Converts a block limit to the whole KiB the filesystem keeps."""
+        value = str(value).strip().lower()
+        try:
+            if value and value[-1] in cls.suffixes:
+                return str(int(value[:-1]) << 10 * (cls.suffixes.index(value[-1]) + 1) >> 10)
+            return str(int(value) >> 10)
+        except ValueError:
+            return value
+
+    def limits(self):
+        bsoft, bhard, isoft, ihard = super().limits()
+        return self._kib(bsoft), self._kib(bhard), isoft, ihard
+
+    def limit_command(self):
+        return 'limit {0} bsoft={1} bhard={2} isoft={3} ihard={4} {5}'.format(
             self.idtype_flags[self.idtype],
             self._bsoft if str(self._bsoft) != '0' else 'unlimited', 
             self._bhard if str(self._bhard) != '0' else 'unlimited', 
             self._isoft if str(self._isoft) != '0' else 'unlimited', 
             self._ihard if str(self._ihard) != '0' else 'unlimited',
-            self.identity, self.fsname
+            self.identity
         )
 
+    def set_command(self):
+        return "/usr/sbin/xfs_quota -x -c '{0}' {1}".format(self.limit_command(), self.fsname)
+
+    @classmethod
+    def batch_set_commands(cls, quotas):
+        return [(
+            '/usr/sbin/xfs_quota -x {0} {1}'.format(
+                ' '.join("-c '{0}'".format(q.limit_command()) for q in batch), batch[0].fsname
+            ),
+            None,
+            batch
+        ) for batch in _chunks(quotas, cls.max_batch)]
+
 
 class ZfsQuota(FilesystemQuota):
     supported_filesystems = ['zfs']
@@ -147,7 +330,12 @@ class ZfsQuota(FilesystemQuota):
         'user': 'user',
         'group': 'group',
     }
-    
+    limit_fields = ('_bhard', '_ihard')
+
+    @classmethod
+    def filesystem_name(cls, mount):
+        return mount.spec
+
     def get_command(self):
         return (
             '/sbin/zfs get -H -p -o value' +
@@ -155,12 +343,147 @@ class ZfsQuota(FilesystemQuota):
         ).format(self.idtype, self.identity, self.fsname)
 
     def parse(self, stdout):
-        bused, bhard, iused, ihard = stdout.split()
+        bhard, bused, ihard, iused = [_limit(v) for v in stdout.split()]
         return bused, bhard, bhard, iused, ihard, ihard
 
-    def set_command(self):
-        return '/sbin/zfs set {0}quota@{1}={3} {0}objquota@{1}={4} {2}'.format(
-            self.idtype, self.identity, self.fsname,
+    @classmethod
+    def report_command(cls, fsname, idtype='user'):
+        return '/sbin/zfs {0}space -H -p -o name,used,quota,objused,objquota -t posix{0} {1}'.format(
+            idtype, fsname
+        )
+
+    @classmethod
+    def parse_report(cls, lines):
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5:
+                continue
+            identity, bused, bhard, iused, ihard = fields
+            yield identity, (bused, bhard, bhard, iused, ihard, ihard)
+
+    def properties(self):
+        return '{0}quota@{1}={2} {0}objquota@{1}={3}'.format(
+            self.idtype, self.identity,
             self._bhard if str(self._bhard) != '0' else 'none', 
             self._ihard if str(self._ihard) != '0' else 'none',
         )
+
+    def set_command(self):
+        return '/sbin/zfs set {0} {1}'.format(self.properties(), self.fsname)
+
+    @classmethod
+    def batch_set_commands(cls, quotas):
+        return [(
+            '/sbin/zfs set {0} {1}'.format(
+                ' '.join(q.properties() for q in batch), batch[0].fsname
+            ),
+            None,
+            batch
+        ) for batch in _chunks(quotas, cls.max_batch)]
+
+
+def _identity_keys(identity, idtype):
+    """Yields the keys under which a report may list identity, which may be
+    given by name or ID. Reports made with ``-n`` are keyed by ID.
+    """
+    identity = str(identity)
+    yield identity
+    db = {'user': pwd, 'group': grp}.get(idtype)
+    if db is None:
+        return
+    try:
+        if identity.isdigit():
+            entry = db.getpwuid(int(identity)) if db is pwd else db.getgrgid(int(identity))
+            yield entry[0]
+        else:
+            entry = db.getpwnam(identity) if db is pwd else db.getgrnam(identity)
+            yield str(entry[2])
+    except KeyError:
+        pass
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def quota_class(vfstype):
+    """Returns the ``FilesystemQuota`` class which supports the given
+    filesystem type, or None if there isn't one.
+    """
+    for cls in (FilesystemQuota, LustreQuota, XfsQuota, ZfsQuota):
+        if vfstype in cls.supported_filesystems:
+            return cls
+    return None
+
+
+async def query_quotas(quotas, runner=None):
+    """Queries every quota concurrently, as far as runner allows, returning
+    a list of ``QuotaResult(quota, status, error)`` in input order, where
+    status is ``'queried'`` or ``'failed'``. For example::
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(query_quotas(
+            LustreQuota(fs, 'jdoe') for fs in filesystems
+        ))
+    """
+    quotas = list(quotas)
+    outcomes = await asyncio.gather(
+        *[q.query_async(runner) for q in quotas], return_exceptions=True
+    )
+    return [
+        QuotaResult(q, 'failed', e) if isinstance(e, Exception) else QuotaResult(q, 'queried', None)
+        for q, e in zip(quotas, outcomes)
+    ]
+
+
+def apply_quotas(quotas, max_workers=4, skip_unchanged=True):
+    """Applies many quotas using as few commands as each filesystem allows.
+    Quotas are grouped by class, filesystem and idtype, and when 
+    ``skip_unchanged`` is set, each group's current limits are gathered with
+    one ``report`` and quotas which already match are skipped. Reports and
+    commands are run at most ``max_workers`` at a time.
+
+    Returns a list of ``QuotaResult(quota, status, error)`` in input order, 
+    where status is one of ``'applied'``, ``'skipped'`` or ``'failed'``.
+    """
+    quotas = list(quotas)
+    groups = collections.OrderedDict()
+    for q in quotas:
+        groups.setdefault((type(q), q.fsname, q.idtype), []).append(q)
+    results = {}
+
+    def plan(key):
+        cls, fsname, idtype = key
+        pending = groups[key]
+        if skip_unchanged:
+            try:
+                current = cls.report(fsname, idtype)
+            except Exception as e:
+                logger.warning('Unable to report quotas for %s: %s', fsname, e)
+                current = {}
+            pending = []
+            for q in groups[key]:
+                found = next((
+                    current[k] for k in _identity_keys(q.identity, idtype) if k in current
+                ), None)
+                if found is not None and found.limits() == q.limits():
+                    results[id(q)] = QuotaResult(q, 'skipped', None)
+                else:
+                    pending.append(q)
+        return cls.batch_set_commands(pending) if pending else []
+
+    def run(job):
+        cmd, stdin, batch = job
+        try:
+            run_cmd(cmd, input=stdin)
+            error = None
+        except Exception as e:
+            error = e
+        for q in batch:
+            results[id(q)] = QuotaResult(q, 'failed' if error else 'applied', error)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        jobs = [job for jobs in pool.map(plan, groups) for job in jobs]
+        list(pool.map(run, jobs))
+
+    return [results[id(q)] for q in quotas]
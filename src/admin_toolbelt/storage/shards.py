@@ -0,0 +1,93 @@
+"""
+    admin_toolbelt.storage.shards
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides the pieces of a distributed directory scan. The tree
+    is split into shards, each rooted at a directory, which are scanned
+    independently, possibly on different hosts. A shard stops after visiting
+    a bounded number of directories and hands back the subdirectories it
+    didn't reach as new shards, so large subtrees are split adaptively as
+    they are discovered. See ``tasks.ScanCoordinator`` for running shards
+    over dramatiq workers.
+"""
+import collections
+import datetime
+
+from .walk import UnusedPeriodPolicy, _scan_one
+
+__all__ = [
+    'ShardResult',
+    'ShardedScanResult',
+    'scan_shard',
+    'shard_policy',
+]
+
+ShardResult = collections.namedtuple(
+    'ShardResult', 'path dirs files matched matched_bytes matches children'
+)
+
+
+def shard_policy(unused_days=None):
+    """Returns the policy for a shard message's arguments, which must be
+    serializable, or None to match every file.
+    """
+    if unused_days is None:
+        return None
+    return UnusedPeriodPolicy(datetime.timedelta(days=unused_days))
+
+
+def scan_shard(path, policy=None, max_dirs=1000, max_fanout=100, collect=True):
+    """Scans the subtree rooted at path, visiting at most ``max_dirs``
+    directories, and returns a ``ShardResult``. The subdirectories of any
+    directory with more than ``max_fanout`` of them, and those left over
+    once ``max_dirs`` is reached, are returned as ``children`` to be scanned
+    as shards of their own. The paths of matching files are included in
+    ``matches`` when ``collect`` is set.
+    """
+    stack, children, matches = [path], [], []
+    dirs = files = matched = matched_bytes = 0
+    while stack and dirs < max_dirs:
+        subdirs, found, checked = _scan_one(stack.pop(), policy)
+        dirs += 1
+        files += checked
+        for entry in found:
+            matched += 1
+            try:
+                matched_bytes += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+            if collect:
+                matches.append(entry.path)
+        if len(subdirs) > max_fanout:
+            children.extend(subdirs)
+        else:
+            stack.extend(reversed(subdirs))
+    children.extend(reversed(stack))
+    return ShardResult(path, dirs, files, matched, matched_bytes, matches, children)
+
+
+class ShardedScanResult(object):
+    """Totals of every shard in a scan, along with the shards which could
+    not be completed in ``failed``, mapped to their last error.
+    """
+    def __init__(self):
+        self.shards = 0
+        self.dirs = self.files = self.matched = self.matched_bytes = 0
+        self.matches = []
+        self.failed = {}
+
+    def add(self, result):
+        """Adds a ``ShardResult``, or its ``_asdict()`` form, to the totals."""
+        if isinstance(result, dict):
+            result = ShardResult(**result)
+        self.shards += 1
+        self.dirs += result.dirs
+        self.files += result.files
+        self.matched += result.matched
+        self.matched_bytes += result.matched_bytes
+        self.matches.extend(result.matches)
+
+    def __repr__(self):
+        return '<ShardedScanResult shards={0} dirs={1} files={2} matched={3} failed={4}>'.format(
+            self.shards, self.dirs, self.files, self.matched, len(self.failed)
+        )
@@ -0,0 +1,219 @@
+"""
+    admin_toolbelt.storage.snapshots
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides a store for periodic samples of quota usage and
+    limits, so that growth can be tracked and users warned before reaching
+    their limits without running quota commands again.
+"""
+import collections
+import datetime
+import sqlite3
+import threading
+import time
+
+__all__ = [
+    'Growth',
+    'QuotaSnapshotStore',
+    'Sample',
+]
+
+Sample = collections.namedtuple('Sample', 'timestamp bused bsoft bhard iused isoft ihard')
+Growth = collections.namedtuple(
+    'Growth', 'fsname idtype identity start end before after delta rate'
+)
+
+_FIELDS = ('bused', 'bsoft', 'bhard', 'iused', 'isoft', 'ihard')
+_USAGE_FIELDS = ('bused', 'iused')
+
+
+def _to_int(value):
+    if value is None:
+        return None
+    try:
+        return int(str(value).rstrip('*'))
+    except ValueError:
+        return None
+
+
+def _to_epoch(value):
+    if value is None:
+        return int(time.time())
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp())
+    return int(value)
+
+
+def _seconds(period):
+    if isinstance(period, datetime.timedelta):
+        return period.total_seconds()
+    return period
+
+
+class QuotaSnapshotStore(object):
+    """Records usage and limit samples per ``(fsname, idtype, identity)`` in
+    an SQLite database at ``path``. Identities are stored once and samples
+    are kept in a table clustered by identity and time, holding only
+    integers.
+
+    For example, to sample every user on a filesystem once an hour and find
+    those growing fastest::
+
+        store = QuotaSnapshotStore('/var/lib/quota_snapshots.db')
+        store.record_report(LustreQuota, '/lustre/scratch')
+        store.top_growers(10, period=datetime.timedelta(hours=24))
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._ids = {}
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS identities (
+                id INTEGER PRIMARY KEY, fsname TEXT, idtype TEXT, identity TEXT,
+                UNIQUE (fsname, idtype, identity)
+            );
+            CREATE TABLE IF NOT EXISTS samples (
+                identity_id INTEGER, ts INTEGER,
+                bused INTEGER, bsoft INTEGER, bhard INTEGER,
+                iused INTEGER, isoft INTEGER, ihard INTEGER,
+                PRIMARY KEY (identity_id, ts)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def _identity_id(self, fsname, idtype, identity):
+        key = (fsname, idtype, str(identity))
+        if key not in self._ids:
+            self.db.execute(
+                'INSERT OR IGNORE INTO identities (fsname, idtype, identity) VALUES (?, ?, ?)', key
+            )
+            self._ids[key] = self.db.execute(
+                'SELECT id FROM identities WHERE fsname = ? AND idtype = ? AND identity = ?', key
+            ).fetchone()[0]
+        return self._ids[key]
+
+    def record(self, quotas, timestamp=None):
+        """Records a sample for each ``FilesystemQuota`` in quotas, querying
+        any which haven't been queried yet. Returns the number recorded.
+        """
+        ts = _to_epoch(timestamp)
+        count = 0
+        with self._lock, self.db:
+            for q in quotas:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (self._identity_id(q.fsname, q.idtype, q.identity), ts) + tuple(
+                        _to_int(getattr(q, f)) for f in _FIELDS
+                    )
+                )
+                count += 1
+        return count
+
+    def record_report(self, cls, fsname, idtype='user', timestamp=None):
+        """Records every identity on a filesystem using a single
+        ``cls.report`` call, where cls is a ``FilesystemQuota`` subclass.
+        """
+        return self.record(cls.report(fsname, idtype).values(), timestamp)
+
+    def samples(self, fsname, identity, idtype='user', since=None):
+        """Returns the list of ``Sample`` recorded for an identity."""
+        rows = self.db.execute('''
+            SELECT s.ts, s.bused, s.bsoft, s.bhard, s.iused, s.isoft, s.ihard
+            FROM samples s JOIN identities i ON i.id = s.identity_id
+            WHERE i.fsname = ? AND i.idtype = ? AND i.identity = ? AND s.ts >= ?
+            ORDER BY s.ts
+        ''', (fsname, idtype, str(identity), _to_epoch(since) if since else 0))
+        return [Sample(*row) for row in rows]
+
+    def deltas(self, period=datetime.timedelta(hours=24), field='bused', fsname=None,
+            idtype=None, limit=None, now=None):
+        """Returns the change in ``field`` (``'bused'`` or ``'iused'``) of
+        every identity with at least two samples in the last ``period``, as
+        ``Growth`` tuples ordered from largest to smallest growth. ``rate``
+        is the change per second between the first and last samples.
+        """
+        if field not in _USAGE_FIELDS:
+            raise ValueError('Invalid field "{0}". Valid values are "{1}"'.format(
+                field, ', '.join(_USAGE_FIELDS)
+            ))
+        since = _to_epoch(now) - _seconds(period)
+        where, params = ['i.id = w.identity_id'], [since]
+        if fsname is not None:
+            where.append('i.fsname = ?')
+            params.append(fsname)
+        if idtype is not None:
+            where.append('i.idtype = ?')
+            params.append(idtype)
+        sql = '''
+            WITH w AS (
+                SELECT identity_id, MIN(ts) AS t0, MAX(ts) AS t1 FROM samples
+                WHERE ts >= ? GROUP BY identity_id HAVING t1 > t0
+            )
+            SELECT i.fsname, i.idtype, i.identity, w.t0, w.t1, a.{0}, b.{0}
+            FROM w JOIN identities i ON {1}
+            JOIN samples a ON a.identity_id = w.identity_id AND a.ts = w.t0
+            JOIN samples b ON b.identity_id = w.identity_id AND b.ts = w.t1
+            WHERE a.{0} IS NOT NULL AND b.{0} IS NOT NULL
+            ORDER BY b.{0} - a.{0} DESC
+        '''.format(field, ' AND '.join(where))
+        if limit is not None:
+            sql += ' LIMIT {0:d}'.format(limit)
+
+        result = []
+        for fs, idt, identity, t0, t1, before, after in self.db.execute(sql, params):
+            result.append(Growth(
+                fs, idt, identity, t0, t1, before, after, after - before,
+                float(after - before) / (t1 - t0)
+            ))
+        return result
+
+    def top_growers(self, n=10, period=datetime.timedelta(hours=24), field='bused',
+            fsname=None, idtype=None, now=None):
+        """Returns the ``n`` identities whose usage grew the most over the
+        last ``period``.
+        """
+        return self.deltas(period, field, fsname=fsname, idtype=idtype, limit=n, now=now)
+
+    def time_to_limit(self, fsname, identity, idtype='user', field='bused',
+            period=datetime.timedelta(days=7), now=None):
+        """Projects how long until an identity reaches its hard limit (or its
+        soft limit if no hard limit is set) using a least-squares fit of the
+        samples from the last ``period``. Returns a ``datetime.timedelta``,
+        or None if there is no limit, too few samples or usage isn't growing.
+        """
+        if field not in _USAGE_FIELDS:
+            raise ValueError('Invalid field "{0}". Valid values are "{1}"'.format(
+                field, ', '.join(_USAGE_FIELDS)
+            ))
+        since = _to_epoch(now) - _seconds(period)
+        samples = [
+            s for s in self.samples(fsname, identity, idtype, since=since)
+            if getattr(s, field) is not None
+        ]
+        if len(samples) < 2:
+            return None
+
+        latest = samples[-1]
+        limit = getattr(latest, field[0] + 'hard') or getattr(latest, field[0] + 'soft')
+        if not limit:
+            return None
+        used = getattr(latest, field)
+        if used >= limit:
+            return datetime.timedelta(0)
+
+        xs = [s.timestamp for s in samples]
+        ys = [getattr(s, field) for s in samples]
+        mx, my = sum(xs) / float(len(xs)), sum(ys) / float(len(ys))
+        var = sum((x - mx) ** 2 for x in xs)
+        slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var if var else 0
+        if slope <= 0:
+            return None
+        return datetime.timedelta(seconds=(limit - used) / slope)
+
+    def prune(self, before):
+        """Deletes samples recorded before the given time."""
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM samples WHERE ts < ?', (_to_epoch(before),))
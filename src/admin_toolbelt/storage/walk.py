@@ -0,0 +1,240 @@
+"""
+    admin_toolbelt.storage.walk
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides the directory traversal used for finding files
+    which match a policy, such as files which haven't been used in a while.
+    Traversal is built on ``os.scandir`` so that policies can reuse the
+    information already gathered while listing a directory, and can be
+    spread over a pool of threads so that many metadata requests are in
+    flight at once on network and parallel filesystems.
+
+    Where the filesystem can filter files itself, such as with ``lfs find``
+    on Lustre, the traversal is offloaded to it through a scan backend which
+    is chosen from the type of the filesystem being walked.
+"""
+import collections
+import concurrent.futures
+import datetime
+import logging
+import math
+import os
+import shlex
+import shutil
+import time
+
+from ..utils import iter_cmd
+from .mounts import get_mount_info
+
+__all__ = [
+    'LfsFindBackend',
+    'PythonScanBackend',
+    'SCAN_BACKENDS',
+    'UnusedPeriodPolicy',
+    'scan_dirs',
+    'select_backend',
+    'visit_dirs',
+]
+
+logger = logging.getLogger(__name__)
+
+
+class UnusedPeriodPolicy(object):
+    """Instances of this policy return True if the file at the given path
+    hasn't been accessed or modified within the given time period, which
+    should be an instance of ``datetime.timedelta``.
+    """
+    def __init__(self, period=datetime.timedelta(days=30)):
+        self.period = period
+
+    def check_stat(self, st):
+        cutoff = time.time() - self.period.total_seconds()
+        return st.st_atime < cutoff and st.st_mtime < cutoff
+
+    def check_entry(self, entry):
+        """Like calling the policy, but accepts an ``os.DirEntry``."""
+        return self.check_stat(entry.stat(follow_symlinks=False))
+
+    def __call__(self, path):
+        return self.check_stat(os.lstat(path))
+
+
+def _matches(policy, entry):
+    """Evaluates policy against entry, using its ``check_entry`` method if it
+    has one and calling it with the entry's path otherwise.
+    """
+    if policy is None:
+        return True
+    check_entry = getattr(policy, 'check_entry', None)
+    if check_entry is not None:
+        return check_entry(entry)
+    return policy(entry.path)
+
+
+def _scan_one(path, policy):
+    """Lists a single directory, returning the paths of its subdirectories,
+    the entries of everything else which matches policy and the number of
+    those checked. Symlinks are never followed, so they are checked like
+    files even when they point to a directory, as ``find ! -type d`` would.
+    Like ``os.walk``, unreadable directories and vanished files are skipped.
+    """
+    subdirs, matches, checked = [], [], 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    checked += 1
+                    if _matches(policy, entry):
+                        matches.append(entry)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return subdirs, matches, checked
+
+
+def scan_dirs(dirs, policy=None, workers=1):
+    """Provided a list of directories, ``dirs``, recursively yields an
+    ``os.DirEntry`` for each file for which the provided policy returns
+    True, or for every file if policy is None.
+
+    With ``workers`` greater than one, directories are listed and the policy
+    evaluated on a pool of that many threads, so policies must be thread-safe.
+    Entries are still yielded to the calling thread, in no particular order.
+    """
+    if workers <= 1:
+        stack = list(reversed(dirs))
+        while stack:
+            subdirs, matches, _ = _scan_one(stack.pop(), policy)
+            for entry in matches:
+                yield entry
+            stack.extend(reversed(subdirs))
+        return
+
+    queued = collections.deque(dirs)
+    pending = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while queued or pending:
+            # Bound the number of outstanding futures on very wide trees
+            while queued and len(pending) < workers * 4:
+                pending.add(pool.submit(_scan_one, queued.popleft(), policy))
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                subdirs, matches, _ = future.result()
+                queued.extend(subdirs)
+                for entry in matches:
+                    yield entry
+
+
+class PythonScanBackend(object):
+    """Walks the tree from this host using ``scan_dirs``. Supports any
+    policy, and is used whenever no other backend applies.
+    """
+    name = 'python'
+
+    def __init__(self, workers=1):
+        self.workers = workers
+
+    def supports(self, policy):
+        return True
+
+    def scan(self, dirs, policy):
+        """Yields the path of each matching file under dirs."""
+        for entry in scan_dirs(dirs, policy, workers=self.workers):
+            yield entry.path
+
+
+class LfsFindBackend(object):
+    """Offloads the walk to ``lfs find``, letting the Lustre servers filter
+    by time instead of statting every file from the client. Only supports
+    ``UnusedPeriodPolicy``, whose period is rounded up to whole days since
+    that is the resolution of ``-atime`` and ``-mtime``. Like the Python
+    walker, it matches everything but directories, including symlinks.
+    """
+    name = 'lfs'
+
+    def __init__(self, lfs='lfs'):
+        self.lfs = lfs
+
+    def supports(self, policy):
+        return (isinstance(policy, UnusedPeriodPolicy)
+            and type(policy).check_stat is UnusedPeriodPolicy.check_stat
+            and shutil.which(self.lfs) is not None)
+
+    def command(self, path, policy):
+        days = int(math.ceil(policy.period.total_seconds() / 86400.0))
+        return '{0} find {1} ! -type d -atime +{2} -mtime +{2} -print0'.format(
+            shlex.quote(self.lfs), shlex.quote(path), days
+        )
+
+    def scan(self, dirs, policy):
+        """Yields the path of each matching file under dirs."""
+        for path in dirs:
+            for record in iter_cmd(self.command(path, policy), sep='\0'):
+                yield record
+
+
+# Maps filesystem types to the backend class used to walk them
+SCAN_BACKENDS = {
+    'lustre': LfsFindBackend,
+}
+
+
+def select_backend(path, policy, workers=1):
+    """Returns the scan backend to use for walking path with policy, based on
+    the type of the filesystem it resides on.
+    """
+    try:
+        vfstype = get_mount_info(path).vfstype
+    except OSError:
+        vfstype = None
+    if vfstype in SCAN_BACKENDS:
+        backend = SCAN_BACKENDS[vfstype]()
+        if backend.supports(policy):
+            return backend
+        logger.debug('%s backend does not support %r, walking %s from Python',
+            backend.name, policy, path)
+    return PythonScanBackend(workers=workers)
+
+
+def visit_dirs(dirs, policy=UnusedPeriodPolicy(), action=print, workers=1, backend=None):
+    """Provided a list of directories, ``dirs``, recursively searches for files
+    for which the provided policy returns True, and execute the given action on
+    them. ``policy`` and ``action`` should be callable objects accepting a file
+    path as their only argument. By default, prints the path of all files that
+    haven't been accessed or modified in over 30 days.
+
+    Policies may also provide a ``check_entry`` method accepting an
+    ``os.DirEntry``, which is used instead to avoid statting files twice.
+    ``workers`` is the number of threads used to walk the tree (see
+    ``scan_dirs``), the action is always called from the calling thread.
+
+    ``backend`` is the scan backend used to find the files, such as
+    ``LfsFindBackend()``. By default one is chosen for each directory with
+    ``select_backend``, using the Python walker unless the filesystem has an
+    entry in ``SCAN_BACKENDS`` that supports the policy. Only the Python
+    walker uses ``workers``, other backends parallelize the walk themselves.
+
+    For example, to institute a purge of any files in the directories over 30
+    days old, you could set ``action=os.remove``.
+    """
+    if backend is not None:
+        groups = [(backend, list(dirs))]
+    else:
+        groups = collections.OrderedDict()
+        for path in dirs:
+            selected = select_backend(path, policy, workers)
+            groups.setdefault(selected.name, (selected, []))[1].append(path)
+        groups = groups.values()
+
+    for selected, paths in groups:
+        if workers > 1 and not isinstance(selected, PythonScanBackend):
+            logger.info('%s backend ignores workers=%d for %s',
+                selected.name, workers, ', '.join(paths))
+        for path in selected.scan(paths, policy):
+            action(path)
@@ -1,6 +1,37 @@
+"""
+    admin_toolbelt.tasks
+    ~~~~~~~~~~~~~~~~~~~~
+
+    This module provides dramatiq actors for the storage functions. The
+    ``provision_path`` and ``provision_paths`` actors limit the rate and
+    concurrency of work on each mount point across every worker, merge
+    messages for the same filesystem which arrive together into a single
+    ``create_paths`` call, and skip messages whose work was already done.
+
+    ``ScanCoordinator`` spreads a directory scan over the workers as shards
+    handled by the ``scan_shard`` actor, and ``MetricsMiddleware`` records
+    how long messages wait and run.
+"""
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
 import dramatiq
+from dramatiq.common import q_name
+from dramatiq.middleware import Middleware
+from dramatiq.rate_limits import ConcurrentRateLimiter, WindowRateLimiter
+from dramatiq.rate_limits.backends import StubBackend
+from dramatiq.results import ResultFailure, ResultMissing
+
+from .metrics import MetricsRegistry
+from .storage import create_path, create_paths, get_mount_info, shards
 
-from .storage import create_path
+logger = logging.getLogger(__name__)
 
 
 def set_actor_queue(actor, queue_name):
@@ -8,3 +39,374 @@ def set_actor_queue(actor, queue_name):
     actor.queue_name = queue_name
 
 create_path = dramatiq.actor(create_path)
+
+
+class DuplicateInProgress(Exception):
+    """Raised when another worker is processing a message with the same
+    dedupe key, so that this one is retried once it has finished.
+    """
+
+
+class _Batch(object):
+    __slots__ = ('specs', 'full', 'done', 'results', 'error')
+
+    def __init__(self):
+        self.specs = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results, self.error = None, None
+
+
+class StorageThrottle(object):
+    """Shared state of the storage actors. ``backend`` is a dramatiq rate
+    limiter backend, which must be shared by every worker (such as a
+    ``RedisBackend``) for the limits and deduplication to apply across them.
+
+    For each mount point, at most ``concurrency`` batches run at once and at
+    most ``rate`` start per ``window`` milliseconds; messages over the limits
+    raise ``RateLimitExceeded`` and are retried later by dramatiq. Messages
+    for the same mount arriving within ``linger`` seconds of each other in a
+    worker process are handled together, up to ``max_batch`` at a time.
+
+    Dedupe keys are held for ``claim_ttl`` milliseconds while their message is
+    processed, and for ``dedupe_ttl`` milliseconds once it has succeeded.
+    """
+    def __init__(self, backend=None, concurrency=2, rate=10, window=1000, linger=0.25,
+            max_batch=500, claim_ttl=600000, dedupe_ttl=86400000):
+        self.backend = backend if backend is not None else StubBackend()
+        self.concurrency, self.rate, self.window = concurrency, rate, window
+        self.linger, self.max_batch = linger, max_batch
+        self.claim_ttl, self.dedupe_ttl = claim_ttl, dedupe_ttl
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    @contextlib.contextmanager
+    def limit(self, mount_point):
+        """Holds one of the mount's concurrency slots within its rate."""
+        window = WindowRateLimiter(
+            self.backend, 'admin_toolbelt-rate:' + mount_point,
+            limit=self.rate, window=self.window
+        )
+        concurrent = ConcurrentRateLimiter(
+            self.backend, 'admin_toolbelt-concurrency:' + mount_point,
+            limit=self.concurrency, ttl=self.claim_ttl
+        )
+        with window.acquire(), concurrent.acquire():
+            yield
+
+    # Dedupe keys hold 1 while claimed and 2 once done, so every transition
+    # is a single bounded incr, decr or add on the backend.
+
+    def claim(self, key):
+        """Returns True if the caller should do the work for key, or False
+        if it has already been done. Raises ``DuplicateInProgress`` if
+        another worker holds it.
+        """
+        key = 'admin_toolbelt-dedupe:' + key
+        if self.backend.incr(key, 1, maximum=1, ttl=self.claim_ttl):
+            return True
+        if self.backend.decr(key, 0, minimum=2, ttl=self.dedupe_ttl):
+            return False
+        raise DuplicateInProgress(key)
+
+    def finish(self, key, succeeded):
+        key = 'admin_toolbelt-dedupe:' + key
+        if succeeded:
+            # The claim expires if the work outlasts claim_ttl, and an incr
+            # of the missing key would leave it looking claimed
+            if not self.backend.add(key, 2, ttl=self.dedupe_ttl):
+                self.backend.incr(key, 1, maximum=2, ttl=self.dedupe_ttl)
+        else:
+            self.backend.decr(key, 1, minimum=0, ttl=self.claim_ttl)
+
+    def _run(self, mount_point, specs):
+        with self.limit(mount_point):
+            return create_paths(specs, quota_existing=True)
+
+    def submit(self, spec):
+        """Creates the path described by spec along with any other specs for
+        the same mount submitted within ``linger`` seconds, returning its
+        ``PathResult``.
+        """
+        mount_point = get_mount_info(os.path.dirname(os.path.abspath(spec['path']))).file
+        with self._lock:
+            batch = self._pending.get(mount_point)
+            leader = batch is None
+            if leader:
+                batch = self._pending[mount_point] = _Batch()
+            index = len(batch.specs)
+            batch.specs.append(spec)
+            if len(batch.specs) >= self.max_batch:
+                del self._pending[mount_point]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.linger)
+            with self._lock:
+                if self._pending.get(mount_point) is batch:
+                    del self._pending[mount_point]
+            try:
+                batch.results = self._run(mount_point, batch.specs)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def submit_many(self, specs):
+        """Creates the paths described by specs, grouped by mount, returning
+        a list of ``PathResult`` in input order.
+        """
+        groups = collections.OrderedDict()
+        for i, spec in enumerate(specs):
+            mnt = get_mount_info(os.path.dirname(os.path.abspath(spec['path'])))
+            groups.setdefault(mnt.file, []).append(i)
+        results = [None] * len(specs)
+        for mount_point, indexes in groups.items():
+            for i, result in zip(indexes, self._run(mount_point, [specs[i] for i in indexes])):
+                results[i] = result
+        return results
+
+
+throttle = StorageThrottle()
+
+
+def set_storage_throttle(backend=None, **kwargs):
+    """Replaces the throttle used by the storage actors, accepting the
+    arguments of ``StorageThrottle``.
+    """
+    global throttle
+    throttle = StorageThrottle(backend, **kwargs)
+    return throttle
+
+
+def _dedupe_key(name, value):
+    return name + ':' + hashlib.sha1(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _raise_failures(results):
+    for result in results:
+        if result.status == 'failed':
+            raise result.error
+
+
+@dramatiq.actor
+def provision_path(path, owner, group, mode=0o700, copy_files=(), usage_quota=None,
+        inode_quota=None, dedupe_key=None):
+    """Throttled, batched and deduplicated ``create_path``. Without a
+    ``dedupe_key``, identical messages share one derived from the arguments.
+    """
+    spec = dict(
+        path=path, owner=owner, group=group, mode=mode, copy_files=list(copy_files),
+        usage_quota=usage_quota, inode_quota=inode_quota
+    )
+    key = dedupe_key or _dedupe_key('provision_path', spec)
+    if not throttle.claim(key):
+        logger.info('%s: skipping duplicate %s', path, key)
+        return
+    try:
+        result = throttle.submit(spec)
+        _raise_failures([result])
+    except BaseException:
+        throttle.finish(key, False)
+        raise
+    throttle.finish(key, True)
+    logger.info('%s: %s', path, result.status)
+
+
+@dramatiq.actor
+def provision_paths(specs, dedupe_key=None):
+    """Throttled and deduplicated ``create_paths`` for callers which already
+    batch their requests.
+    """
+    key = dedupe_key or _dedupe_key('provision_paths', specs)
+    if not throttle.claim(key):
+        logger.info('Skipping duplicate %s', key)
+        return
+    try:
+        results = throttle.submit_many(specs)
+        _raise_failures(results)
+    except BaseException:
+        throttle.finish(key, False)
+        raise
+    throttle.finish(key, True)
+    for result in results:
+        logger.info('%s: %s', result.path, result.status)
+
+
+@dramatiq.actor(max_retries=0)
+def scan_shard(path, unused_days=None, max_dirs=1000, max_fanout=100, collect=False):
+    """Scans one shard with ``storage.shards.scan_shard``, matching files
+    unused for ``unused_days`` or every file if None. The paths of matching
+    files are only returned if ``collect`` is set. Sent by
+    ``ScanCoordinator``, which requires the broker to have the ``Results``
+    middleware and retries failed shards itself.
+    """
+    return shards.scan_shard(
+        path, shards.shard_policy(unused_days), max_dirs=max_dirs,
+        max_fanout=max_fanout, collect=collect
+    )._asdict()
+
+
+class ScanCoordinator(object):
+    """Scans the directories in ``roots`` by sending ``scan_shard`` messages
+    and adding up their results as they arrive, sending a new message for
+    each child shard a result returns.
+
+    Only totals are gathered by default. With ``collect`` set, the path of
+    every matching file also passes through the results backend and is
+    kept in the result's ``matches``, so it should only be set for scans
+    expected to match relatively few files.
+
+    A shard whose message fails, or has no result after ``shard_timeout``
+    seconds, as when its worker died, is sent again up to ``max_attempts``
+    times in all, after which it is recorded in the result's ``failed``.
+    Messages are sent with dramatiq's own retries disabled, so that a
+    failure is reported straight away. Only the first result for each shard
+    is counted.
+
+    For example, to count the files unused for 90 days on a filesystem::
+
+        result = ScanCoordinator(['/lustre/scratch'], unused_days=90).run()
+        print(result.matched, result.matched_bytes)
+    """
+    def __init__(self, roots, unused_days=None, max_dirs=1000, max_fanout=100, collect=False,
+            shard_timeout=3600, max_attempts=3, poll_interval=0.5, actor=None):
+        self.roots = list(roots)
+        self.options = dict(
+            unused_days=unused_days, max_dirs=max_dirs, max_fanout=max_fanout, collect=collect
+        )
+        self.shard_timeout, self.max_attempts = shard_timeout, max_attempts
+        self.poll_interval = poll_interval
+        self.actor = actor or scan_shard
+
+    def _send(self, path, attempt):
+        message = self.actor.send_with_options(
+            args=(path,), kwargs=self.options, store_results=True, max_retries=0
+        )
+        return message, attempt, time.monotonic() + self.shard_timeout
+
+    def run(self):
+        """Runs the scan to completion and returns a ``ShardedScanResult``."""
+        result = shards.ShardedScanResult()
+        pending = dict((path, self._send(path, 1)) for path in self.roots)
+        done = set()
+        while pending:
+            progressed = False
+            for path, (message, attempt, deadline) in list(pending.items()):
+                try:
+                    shard = message.get_result(block=False)
+                except ResultMissing:
+                    if time.monotonic() < deadline:
+                        continue
+                    error = 'Timed out after {0}s'.format(self.shard_timeout)
+                except ResultFailure as e:
+                    error = str(e)
+                else:
+                    progressed = True
+                    del pending[path]
+                    if path in done:
+                        continue
+                    done.add(path)
+                    result.add(shard)
+                    for child in shard['children']:
+                        if child not in done and child not in pending:
+                            pending[child] = self._send(child, 1)
+                    continue
+
+                progressed = True
+                if attempt < self.max_attempts:
+                    logger.warning('Retrying shard %s: %s', path, error)
+                    pending[path] = self._send(path, attempt + 1)
+                else:
+                    logger.error('Giving up on shard %s: %s', path, error)
+                    del pending[path]
+                    result.failed[path] = error
+            if pending and not progressed:
+                time.sleep(self.poll_interval)
+        return result
+
+
+def _message_path(message):
+    """Returns the path a storage actor's message works on, if any."""
+    path = message.kwargs.get('path', message.args[0] if message.args else None)
+    if isinstance(path, list) and path and isinstance(path[0], dict):
+        path = path[0].get('path')
+    return path if isinstance(path, str) else None
+
+
+class MetricsMiddleware(Middleware):
+    """Records, per actor, queue and, for the storage actors, the
+    ``vfstype`` of the filesystem being worked on:
+
+    - ``dramatiq_message_wait_seconds``, the time from a message being
+      enqueued, or from its retry coming due, to starting to process it
+    - ``dramatiq_message_seconds``, the time spent processing it
+    - ``dramatiq_messages_total``, by ``status`` of success, failed or skipped
+    - ``dramatiq_message_retries_total``, the number of retried attempts
+
+    For example::
+
+        middleware = MetricsMiddleware()
+        broker.add_middleware(middleware)
+        ...
+        print(middleware.expose())
+    """
+    storage_actors = ('create_path', 'provision_path', 'provision_paths', 'scan_shard')
+
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.registry.describe('dramatiq_message_wait_seconds',
+            'Time from enqueue or retry until processing started.')
+        self.registry.describe('dramatiq_message_seconds', 'Time spent processing messages.')
+        self.registry.describe('dramatiq_messages_total', 'Messages processed by status.')
+        self.registry.describe('dramatiq_message_retries_total', 'Retried message attempts.')
+        self._started = {}
+
+    def _labels(self, message):
+        vfstype = ''
+        if message.actor_name in self.storage_actors:
+            path = _message_path(message)
+            if path is not None:
+                try:
+                    vfstype = get_mount_info(os.path.dirname(os.path.abspath(path))).vfstype
+                except OSError:
+                    pass
+        return (
+            ('actor', message.actor_name), ('queue', q_name(message.queue_name)),
+            ('vfstype', vfstype),
+        )
+
+    def before_process_message(self, broker, message):
+        now = time.time()
+        labels = self._labels(message)
+        due = message.options.get('eta', message.message_timestamp)
+        self.registry.observe('dramatiq_message_wait_seconds', max(0.0, now - due / 1000.0), labels)
+        if message.options.get('retries'):
+            self.registry.inc('dramatiq_message_retries_total', labels)
+        self._started[message.message_id] = (time.monotonic(), labels)
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        started = self._started.pop(message.message_id, None)
+        if started is None:
+            return
+        start, labels = started
+        self.registry.observe('dramatiq_message_seconds', time.monotonic() - start, labels)
+        status = 'failed' if exception is not None else 'success'
+        self.registry.inc('dramatiq_messages_total', labels + (('status', status),))
+
+    def after_skip_message(self, broker, message):
+        started = self._started.pop(message.message_id, None)
+        labels = started[1] if started is not None else self._labels(message)
+        self.registry.inc('dramatiq_messages_total', labels + (('status', 'skipped'),))
+
+    def expose(self):
+        """Returns the recorded metrics in the Prometheus text format."""
+        return self.registry.expose()
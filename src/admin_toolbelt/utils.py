@@ -6,20 +6,41 @@
     standard library. Includes things like accurately getting the user's
     username and providing an equivalent to ``sort -h``.
 """
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
 import logging
+import operator
 import os
+import pickle
 import pwd
 import re
 import shlex
 import subprocess
+import tempfile
+import threading
+import time
 
 __all__ = [
+    'CommandError',
+    'CommandResult',
+    'CommandRunner',
+    'RateLimiter',
     'first_existing',
     'get_username',
+    'human_numeric_key',
     'human_numeric_sort',
+    'human_numeric_top',
+    'iter_cmd',
+    'iter_human_numeric_sort',
+    'parse_human_numeric',
     'run_cmd',
 ]
 
+logger = logging.getLogger(__name__)
+
 
 def first_existing(d, keys):
     """Returns the value of the first key in keys which exists in d."""
@@ -34,40 +55,329 @@ def get_username():
     return pwd.getpwuid(os.getuid()).pw_name
 
 
-def human_numeric_sort(lines, column=0):
+_HUMAN_NUMERIC = re.compile(r'\s*([-+]?)(\d*\.?\d+|\d+\.)(?:([KMGTPEZY])(i?))?', re.I)
+# sort -h only knows a lowercase 'k', but lowercase suffixes such as '10g'
+# were always accepted here and keep their meaning
+_SUFFIX_RANKS = dict((s, i + 1) for i, s in enumerate('KMGTPEZY'))
+_SUFFIX_RANKS.update((s.lower(), rank) for s, rank in list(_SUFFIX_RANKS.items()))
+
+
+def parse_human_numeric(text, binary=False):
+    """Returns the value of a number such as '15k', '1.5G' or '4KiB' as a
+    float, or None if text doesn't start with a number. IEC suffixes such as
+    'Ki' are powers of 1024, SI suffixes powers of 1000 unless binary is set.
+    """
+    m = _HUMAN_NUMERIC.match(text)
+    if m is None:
+        return None
+    sign, number, suffix, iec = m.groups()
+    value = float(number) * (-1 if sign == '-' else 1)
+    if suffix:
+        value *= (1024 if iec or binary else 1000) ** _SUFFIX_RANKS[suffix]
+    return value
+
+
+def human_numeric_key(line, column=0):
+    """Returns a sort key for line which orders the given whitespace
+    separated column like ``sort -h``: by sign, then by suffix, then by
+    value, so that '1500K' sorts before '1M'. Suffixes are also accepted in
+    lowercase, such as '10g'. Lines without a number in the column sort as
+    zero.
+    """
+    items = line.split(None, column + 1)
+    if len(items) <= column:
+        return (0, 0, 0.0)
+    m = _HUMAN_NUMERIC.match(items[column])
+    if m is None:
+        return (0, 0, 0.0)
+    sign, number, suffix, _ = m.groups()
+    value = float(number)
+    if value == 0:
+        return (0, 0, 0.0)
+    rank = _SUFFIX_RANKS[suffix] if suffix else 0
+    if sign == '-':
+        return (-1, -rank, -value)
+    return (1, rank, value)
+
+
+def human_numeric_sort(lines, column=0, reverse=False):
     """Sorts the given lines numerically on the chosen column, supports suffixes 
-    such as '15k' or '1G'. 
+    such as '15k', '1.5G' or '4KiB' and orders them like ``sort -h``.
+    """
+    return sorted(lines, key=functools.partial(human_numeric_key, column=column),
+        reverse=reverse)
+
+
+def _spill(run):
+    """Writes a sorted run of ``(key, line)`` pairs to a temporary file and
+    returns a generator reading them back.
+    """
+    f = tempfile.TemporaryFile()
+    for item in run:
+        pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+
+    def read():
+        with f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+    return read()
+
+
+def iter_human_numeric_sort(lines, column=0, reverse=False, run_size=100000, max_runs=64):
+    """Like ``human_numeric_sort``, but accepts any iterable of lines, such
+    as an open file or ``iter_cmd``, and yields the sorted lines. At most
+    ``run_size`` lines are held in memory; longer inputs are sorted in runs
+    which are spilled to temporary files and merged with ``heapq.merge``.
+    Every ``max_runs`` runs are merged into a single longer one as they
+    accumulate, so only a few times ``max_runs`` temporary files are open
+    at once however long the input is.
+    """
+    key = functools.partial(human_numeric_key, column=column)
+    merge = functools.partial(heapq.merge, key=operator.itemgetter(0), reverse=reverse)
+    max_runs = max(2, max_runs)
+    # levels[i + 1] holds runs merged from max_runs runs of levels[i], so
+    # each level's runs hold earlier lines than those below it, which keeps
+    # the sort stable
+    levels, lines = [[]], iter(lines)
+    while True:
+        run = [(key(line), line) for line in itertools.islice(lines, run_size)]
+        if not run:
+            break
+        run.sort(key=operator.itemgetter(0), reverse=reverse)
+        if len(run) < run_size and levels == [[]]:
+            # Everything fit in memory
+            for _, line in run:
+                yield line
+            return
+        levels[0].append(_spill(run))
+        for i, runs in enumerate(levels):
+            if len(runs) < max_runs:
+                break
+            if i + 1 == len(levels):
+                levels.append([])
+            levels[i + 1].append(_spill(merge(*runs)))
+            del runs[:]
+
+    for _, line in merge(*[run for runs in reversed(levels) for run in runs]):
+        yield line
+
+
+def human_numeric_top(lines, n, column=0, largest=True):
+    """Returns the n lines with the largest (or smallest) values in the
+    chosen column in ``sort -h`` order, keeping only n lines in memory.
+    """
+    key = functools.partial(human_numeric_key, column=column)
+    if largest:
+        return heapq.nlargest(n, lines, key=key)
+    return heapq.nsmallest(n, lines, key=key)
+
+
+def run_cmd(cmd, input=None):
+    """Execute string cmd as a subprocess of the current process. If given,
+    the string input is written to the command's stdin.
     """
-    def key_func(line):
-        items = line.split()
-        try:
-            item = items[column]
-        except:
-            return -1
-        
-        if re.search(r'^\d+$', item):
-            return int(item)
-            
-        m = re.search(r'(\d+)([kmgtpKMGTP])', item)
-        if m:
-            v, s = int(m.group(1)), m.group(2)
-            if s in 'kK':
-                v *= 1000
-            if s in 'mM':
-                v *= 1000000
-            if s in 'gG':
-                v *= 1000000000
-            if s in 'tT':
-                v *= 1000000000000
-            if s in 'pP':
-                v *= 1000000000000000
-            return v
-        return -1
-        
-    return sorted(lines, key=key_func)
-
-
-def run_cmd(cmd):
-    """Execute string cmd as a subprocess of the current process."""
     logger.info("Running Shell Command: " + cmd)
-    return subprocess.check_output(shlex.split(cmd), universal_newlines=True)
+    return subprocess.check_output(shlex.split(cmd), input=input, universal_newlines=True)
+
+
+def _split_stream(stream, sep, size=65536):
+    """Yields the sep-separated records read from a binary stream, decoded
+    with the filesystem encoding so that they can be used as paths.
+    """
+    pending = b''
+    for chunk in iter(lambda: stream.read(size), b''):
+        records = (pending + chunk).split(sep)
+        pending = records.pop()
+        for record in records:
+            yield os.fsdecode(record)
+    if pending:
+        yield os.fsdecode(pending)
+
+
+def iter_cmd(cmd, sep=None):
+    """Execute string cmd as a subprocess of the current process, yielding 
+    lines of its output as they are produced rather than buffering all of it.
+    If sep is given, such as ``'\\0'`` for ``find -print0`` style output,
+    records split on sep are yielded instead, without the separator.
+    Raises ``subprocess.CalledProcessError`` if the command fails.
+    """
+    logger.info("Running Shell Command: " + cmd)
+    proc = subprocess.Popen(
+        shlex.split(cmd), stdout=subprocess.PIPE, universal_newlines=sep is None
+    )
+    finished = False
+    try:
+        if sep is None:
+            for line in proc.stdout:
+                yield line
+        else:
+            for record in _split_stream(proc.stdout, os.fsencode(sep)):
+                yield record
+        finished = True
+    finally:
+        proc.stdout.close()
+        if not finished:
+            proc.kill()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket which allows ``rate`` operations per second 
+    on average, with bursts of up to ``burst`` operations.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """Blocks until n operations may be performed."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+CommandResult = collections.namedtuple('CommandResult', 'cmd returncode stdout stderr elapsed')
+
+
+class CommandError(Exception):
+    """Raised by ``CommandRunner`` when a command exits with a nonzero status
+    or runs past its timeout, in which case ``timed_out`` is set and
+    ``returncode`` is None.
+    """
+    def __init__(self, cmd, returncode, stdout='', stderr='', elapsed=0.0, timed_out=False):
+        self.cmd, self.returncode = cmd, returncode
+        self.stdout, self.stderr = stdout, stderr
+        self.elapsed, self.timed_out = elapsed, timed_out
+        if timed_out:
+            message = 'Command "{0}" timed out after {1:.1f}s'.format(cmd, elapsed)
+        else:
+            message = 'Command "{0}" exited with status {1}: {2}'.format(
+                cmd, returncode, stderr.strip()
+            )
+        super(CommandError, self).__init__(message)
+
+
+class CommandRunner(object):
+    """Runs commands as asyncio subprocesses, at most ``concurrency`` at a
+    time, killing any which run longer than ``timeout`` seconds. The wall
+    time of each call is returned in its ``CommandResult``, logged, and
+    recorded as ``command_seconds`` in ``registry`` if one is given.
+
+    For example, to run a command on every host of a list at once::
+
+        runner = CommandRunner(concurrency=16, timeout=60)
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(asyncio.gather(
+            *[runner.run('ssh {0} uptime'.format(h)) for h in hosts]
+        ))
+    """
+    def __init__(self, concurrency=8, timeout=None, registry=None):
+        self.concurrency, self.timeout, self.registry = concurrency, timeout, registry
+        self._loop, self._semaphore = None, None
+
+    def _slot(self):
+        # Semaphores belong to the loop they were created in
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop, self._semaphore = loop, asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def _record(self, cmd, elapsed, status):
+        logger.debug('Command "%s" finished with status %s in %.3fs', cmd, status, elapsed)
+        if self.registry is not None:
+            self.registry.observe('command_seconds', elapsed, {
+                'command': os.path.basename(shlex.split(cmd)[0]),
+            })
+
+    async def _kill(self, proc):
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+    async def run(self, cmd, input=None, timeout=None, check=True):
+        """Runs string cmd, writing the string input to its stdin if given,
+        and returns a ``CommandResult``. Raises ``CommandError`` if it times
+        out, or exits with a nonzero status and check is set.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        async with self._slot():
+            logger.info("Running Shell Command: " + cmd)
+            start = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(
+                *shlex.split(cmd), stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                stdin=asyncio.subprocess.PIPE if input is not None else None
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(input.encode() if input is not None else None), timeout
+                )
+            except asyncio.TimeoutError:
+                await self._kill(proc)
+                elapsed = time.monotonic() - start
+                self._record(cmd, elapsed, 'timeout')
+                raise CommandError(cmd, None, elapsed=elapsed, timed_out=True)
+            finally:
+                await self._kill(proc)
+            elapsed = time.monotonic() - start
+
+        self._record(cmd, elapsed, proc.returncode)
+        result = CommandResult(
+            cmd, proc.returncode, stdout.decode(errors='replace'),
+            stderr.decode(errors='replace'), elapsed
+        )
+        if check and result.returncode != 0:
+            raise CommandError(*result)
+        return result
+
+    async def iter_lines(self, cmd, timeout=None):
+        """Runs string cmd, asynchronously yielding lines of its output as
+        they are produced. The timeout applies to the whole command.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        async with self._slot():
+            logger.info("Running Shell Command: " + cmd)
+            loop = asyncio.get_event_loop()
+            start = time.monotonic()
+            deadline = loop.time() + timeout if timeout is not None else None
+            proc = await asyncio.create_subprocess_exec(
+                *shlex.split(cmd), stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            # Drain stderr alongside stdout so a chatty command can't block
+            stderr = asyncio.ensure_future(proc.stderr.read())
+            try:
+                while True:
+                    remaining = deadline - loop.time() if deadline is not None else None
+                    line = await asyncio.wait_for(proc.stdout.readline(), remaining)
+                    if not line:
+                        break
+                    yield line.decode(errors='replace')
+                remaining = deadline - loop.time() if deadline is not None else None
+                await asyncio.wait_for(proc.wait(), remaining)
+            except asyncio.TimeoutError:
+                elapsed = time.monotonic() - start
+                self._record(cmd, elapsed, 'timeout')
+                raise CommandError(cmd, None, elapsed=elapsed, timed_out=True)
+            finally:
+                await self._kill(proc)
+                errors = (await stderr).decode(errors='replace')
+            elapsed = time.monotonic() - start
+
+        self._record(cmd, elapsed, proc.returncode)
+        if proc.returncode != 0:
+            raise CommandError(cmd, proc.returncode, '', errors, elapsed)
@@ -0,0 +1,152 @@
+import pytest
+
+pytest.importorskip('ldap')
+
+from admin_toolbelt.ldap_client import LdapEntry
+from admin_toolbelt.ldap_replica import (LdapReplica, MemoryReplicaStore,
+                                         SqliteReplicaStore, compile_filter)
+
+USER = {
+    'objectClass': [b'posixAccount', b'inetOrgPerson'],
+    'uid': [b'jdoe'],
+    'cn': [b'John Doe'],
+    'uidNumber': [b'1500'],
+    'mail': [b'a*b@example.com'],
+}
+
+
+@pytest.mark.parametrize('filterstr, expected', [
+    ('(uid=jdoe)', True),
+    ('uid=jdoe', True),
+    ('(UID=JDOE)', True),
+    ('(uid=other)', False),
+    ('(mail=*)', True),
+    ('(gecos=*)', False),
+    ('(cn=john*)', True),
+    ('(cn=*doe)', True),
+    ('(cn=j*n*e)', True),
+    ('(cn=*smith*)', False),
+    ('(uidNumber>=1000)', True),
+    ('(uidNumber>=2000)', False),
+    ('(uidNumber<=1500)', True),
+    ('(uidNumber<=999)', False),
+    ('(mail=a\\2ab@example.com)', True),
+    ('(mail=a\\2a*)', True),
+    ('(cn=John\\20Doe)', True),
+    ('(&(objectClass=posixAccount)(uid=jdoe))', True),
+    ('(&(objectClass=posixAccount)(uid=other))', False),
+    ('(|(uid=other)(uidNumber=1500))', True),
+    ('(|(uid=other)(uid=another))', False),
+    ('(!(uid=other))', True),
+    ('(!(uid=jdoe))', False),
+    ('(&(|(uid=other)(cn=john*))(!(uidNumber<=999)))', True),
+])
+def test_compile_filter(filterstr, expected):
+    assert compile_filter(filterstr)(USER) is expected
+
+
+def test_compile_filter_escaped_star_is_literal():
+    entry = dict(USER, mail=[b'axb@example.com'])
+    assert not compile_filter('(mail=a\\2ab@example.com)')(entry)
+
+
+@pytest.mark.parametrize('filterstr', ['(uid=jdoe', '(&(uid=jdoe)', '(uid)', '(uid=jdoe))'])
+def test_compile_filter_invalid(filterstr):
+    with pytest.raises(ValueError):
+        compile_filter(filterstr)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryReplicaStore()
+    return SqliteReplicaStore(str(tmp_path / 'replica.db'))
+
+
+def test_store_put_get_delete(store):
+    store.put('uuid-1', 'user', 'uid=jdoe,ou=People,dc=example,dc=com', USER)
+    store.put('uuid-2', 'group', 'cn=staff,ou=Group,dc=example,dc=com', {'cn': [b'staff']})
+
+    assert store.get('UID=jdoe, ou=People,dc=example,dc=com') == USER
+    assert store.keys('user') == {'uuid-1'}
+    assert [e for dn, e in store.entries('group')] == [{'cn': [b'staff']}]
+
+    # Renames keep the key but move the entry to its new DN
+    store.put('uuid-1', 'user', 'uid=john,ou=People,dc=example,dc=com', USER)
+    assert store.get('uid=jdoe,ou=People,dc=example,dc=com') is None
+    assert store.get('uid=john,ou=People,dc=example,dc=com') == USER
+
+    store.delete('uuid-1')
+    assert store.get('uid=john,ou=People,dc=example,dc=com') is None
+    assert store.keys('user') == set()
+
+
+def test_store_state(store):
+    assert store.get_state('cookie:user') is None
+    store.set_state('cookie:user', 'abc')
+    store.commit()
+    assert store.get_state('cookie:user') == 'abc'
+
+
+class FakeClient(object):
+    """Serves paged searches from a dict of DN to entry per OU."""
+    base, user_ou, group_ou = 'dc=example,dc=com', 'People', 'Group'
+
+    def __init__(self):
+        self.entries = {}
+        self.filters = []
+
+    def add(self, dn, entry, timestamp):
+        self.entries[dn] = dict(entry, modifyTimestamp=[timestamp.encode()])
+
+    def _search_paged_raw(self, base, filterstr='(objectClass=*)', attrs=None, page_size=None):
+        self.filters.append(filterstr)
+        predicate = compile_filter(filterstr)
+        for dn, entry in list(self.entries.items()):
+            if dn.endswith(',' + base) and predicate(entry):
+                yield dn, {} if attrs == ['1.1'] else entry
+
+    def _decode_entry(self, entry, dn=None):
+        return LdapEntry(entry, dn)
+
+    def get_user_string(self, username):
+        return 'uid={0},ou={1},{2}'.format(username, self.user_ou, self.base)
+
+    def get_group_string(self, groupname):
+        return 'cn={0},ou={1},{2}'.format(groupname, self.group_ou, self.base)
+
+
+def test_delta_refresh(store):
+    client = FakeClient()
+    client.add(client.get_user_string('jdoe'), USER, '20240101000000Z')
+    client.add(client.get_user_string('asmith'), dict(USER, uid=[b'asmith']), '20240101000000Z')
+    client.add(client.get_group_string('staff'), {
+        'objectClass': [b'posixGroup'], 'cn': [b'staff'], 'memberUid': [b'jdoe'],
+    }, '20240101000000Z')
+
+    replica = LdapReplica(client, store, use_syncrepl=False)
+    replica.refresh()
+    assert replica.search_user('jdoe')['uid'] == ['jdoe']
+    assert replica.groups_for_user('jdoe') == ['staff']
+    assert store.get_state('timestamp:user') == '20240101000000Z'
+
+    client.add(client.get_user_string('jdoe'), dict(USER, cn=[b'Jon Doe']), '20240102000000Z')
+    del client.entries[client.get_user_string('asmith')]
+    client.filters = []
+    replica.refresh()
+
+    assert '(modifyTimestamp>=20240101000000Z)' in client.filters
+    assert replica.search_user('jdoe')['cn'] == ['Jon Doe']
+    assert replica.search_user('asmith') is None
+    assert store.get_state('timestamp:user') == '20240102000000Z'
+
+
+def test_delta_refresh_without_delete_detection():
+    client = FakeClient()
+    client.add(client.get_user_string('jdoe'), USER, '20240101000000Z')
+    replica = LdapReplica(client, use_syncrepl=False, detect_deletes=False)
+    replica.refresh()
+
+    del client.entries[client.get_user_string('jdoe')]
+    replica.refresh()
+    assert replica.search_user('jdoe') is not None
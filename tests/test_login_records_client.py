@@ -0,0 +1,108 @@
+import datetime
+import glob
+import gzip
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+pytest.importorskip('requests')
+
+from admin_toolbelt.contrib.login_records.client import BatchReporter, LogScanner  # noqa: E402
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Saves batches like ``LoginRecordBatchView``, refusing any batch with
+    a user longer than 32 characters.
+    """
+    def do_POST(self):
+        body = gzip.decompress(self.rfile.read(int(self.headers['Content-Length'])))
+        records = json.loads(body.decode())['records']
+        invalid = [i for i, r in enumerate(records) if len(r['user']) > 32]
+        if invalid:
+            self.respond(400, {'invalid': invalid} if self.server.name_invalid else None)
+        else:
+            self.server.saved.extend(r['user'] for r in records)
+            self.respond(200, {'saved': len(records)})
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(params=[True, False], ids=['named', 'unnamed'])
+def server(request):
+    server = Server(('127.0.0.1', 0), Handler)
+    server.saved, server.name_invalid = [], request.param
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_rejected_records_do_not_block_the_spool(server, tmp_path):
+    url = 'http://127.0.0.1:{0}/records/'.format(server.server_address[1])
+    when = datetime.datetime(2024, 1, 1)
+    users = ['user{0}'.format(i) for i in range(10)]
+    bad = 'x' * 40
+
+    reporter = BatchReporter(url, 'token', str(tmp_path), batch_size=4, max_delay=3600)
+    try:
+        for user in users[:5] + [bad] + users[5:]:
+            reporter.add(when, 'host', 'sshd', user, '10.0.0.1', 'publickey')
+        reporter.flush()
+        reporter.add(when, 'host', 'sshd', 'later', '10.0.0.1', 'publickey')
+    finally:
+        reporter.close()
+
+    assert sorted(server.saved) == sorted(users + ['later'])
+    assert glob.glob(os.path.join(str(tmp_path), '*.batch')) == []
+    rejected = glob.glob(os.path.join(str(tmp_path), '*.rejected'))
+    assert len(rejected) == 1
+    with open(rejected[0]) as f:
+        assert [json.loads(line)['user'] for line in f] == [bad]
+
+
+def login(user):
+    return ('Jan  1 00:00:00 host sshd[1]: Accepted publickey for {0} '
+            'from 10.0.0.1 port 22 ssh2\n'.format(user))
+
+
+def test_scan_reads_rest_of_rotated_log(tmp_path):
+    log, checkpoint = tmp_path / 'auth.log', str(tmp_path / 'checkpoint')
+    log.write_text(login('a') + 'unrelated\n')
+    assert [m.group('user') for m in LogScanner(str(log), checkpoint=checkpoint).scan()] == ['a']
+
+    # Lines written after the last scan but before rotation must not be lost
+    with log.open('a') as f:
+        f.write(login('b'))
+    log.rename(tmp_path / 'auth.log.1')
+    log.write_text(login('c'))
+    scanner = LogScanner(str(log), checkpoint=checkpoint)
+    assert [m.group('user') for m in scanner.scan()] == ['b', 'c']
+    assert [m.group('user') for m in LogScanner(str(log), checkpoint=checkpoint).scan()] == []
+
+
+def test_close_keeps_unsent_records_spooled(tmp_path):
+    server = Server(('127.0.0.1', 0), Handler)
+    url = 'http://127.0.0.1:{0}/records/'.format(server.server_address[1])
+    server.server_close()
+
+    reporter = BatchReporter(url, 'token', str(tmp_path), max_attempts=1)
+    reporter.add(datetime.datetime(2024, 1, 1), 'host', 'sshd', 'jdoe', '10.0.0.1')
+    reporter.close()
+    assert len(glob.glob(os.path.join(str(tmp_path), '*.batch'))) == 1
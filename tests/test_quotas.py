@@ -0,0 +1,56 @@
+import pytest
+
+from admin_toolbelt.storage import quotas
+from admin_toolbelt.storage.quotas import FilesystemQuota, XfsQuota, apply_quotas
+
+XFS_REPORT = [
+    '#0          100      0 1048576  00 [--------]   5   0   0  00 [--------]\n',
+]
+
+REPQUOTA_REPORT = [
+    'Id,BlockStatus,FileStatus,BlockUsed,BlockSoftLimit,BlockHardLimit,BlockGrace,'
+    'FileUsed,FileSoftLimit,FileHardLimit,FileGrace\n',
+    '#0,ok,ok,100,1000,2000,,5,10,20,\n',
+]
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    run = []
+    monkeypatch.setattr(quotas, 'run_cmd', lambda cmd, input=None: run.append(cmd))
+    return run
+
+
+def statuses(results):
+    return [r.status for r in results]
+
+
+def test_xfs_report_is_in_bytes(monkeypatch):
+    monkeypatch.setattr(quotas, 'iter_cmd', lambda cmd: iter(XFS_REPORT))
+    quota = XfsQuota.report('/xfs')['0']
+    assert (quota.bused, quota.bhard) == (str(100 * 1024), str(1 << 30))
+
+
+@pytest.mark.parametrize('bhard, status', [
+    ('1048576', 'applied'),
+    ('1073741824', 'skipped'),
+    ('1g', 'skipped'),
+    ('1024M', 'skipped'),
+    ('2g', 'applied'),
+])
+def test_xfs_skip_unchanged_compares_units(monkeypatch, commands, bhard, status):
+    monkeypatch.setattr(quotas, 'iter_cmd', lambda cmd: iter(XFS_REPORT))
+    results = apply_quotas([XfsQuota('/xfs', '0', block_hard=bhard)])
+    assert statuses(results) == [status]
+    assert len(commands) == (status == 'applied')
+
+
+@pytest.mark.parametrize('identity', ['0', 'root'])
+def test_skip_unchanged_by_name_or_id(monkeypatch, commands, identity):
+    monkeypatch.setattr(quotas, 'iter_cmd', lambda cmd: iter(REPQUOTA_REPORT))
+    results = apply_quotas([
+        FilesystemQuota('/home', identity, 'user', '1000', '2000', '10', '20'),
+        FilesystemQuota('/home', identity, 'user', '1000', '3000', '10', '20'),
+    ])
+    assert statuses(results) == ['skipped', 'applied']
+    assert len(commands) == 1
@@ -0,0 +1,88 @@
+import dramatiq
+import pytest
+from dramatiq.brokers.stub import StubBroker
+from dramatiq.results import Results
+from dramatiq.results.backends import StubBackend
+
+broker = StubBroker()
+broker.add_middleware(Results(backend=StubBackend()))
+dramatiq.set_broker(broker)
+
+from admin_toolbelt import tasks  # noqa: E402
+
+
+@pytest.fixture
+def worker():
+    broker.flush_all()
+    worker = dramatiq.Worker(broker, worker_timeout=50)
+    worker.start()
+    yield worker
+    worker.stop()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """Three top-level directories of ten subdirectories with two files each."""
+    for i in range(3):
+        for j in range(10):
+            path = tmp_path / 'd{0}'.format(i) / 's{0}'.format(j)
+            path.mkdir(parents=True)
+            (path / 'a').write_text('x')
+            (path / 'b').write_text('xy')
+    return tmp_path
+
+
+def test_scan_shard_is_not_retried_by_dramatiq():
+    assert tasks.scan_shard.options['max_retries'] == 0
+
+
+def test_scan_coordinator(worker, tree):
+    result = tasks.ScanCoordinator(
+        [str(tree)], max_dirs=4, max_fanout=5, poll_interval=0.01
+    ).run()
+    assert result.dirs == 1 + 3 + 30
+    assert result.files == result.matched == 60
+    assert result.matched_bytes == 90
+    assert result.matches == []
+    assert result.shards > 1
+    assert not result.failed
+
+
+def test_scan_coordinator_collect(worker, tree):
+    result = tasks.ScanCoordinator(
+        [str(tree)], max_dirs=4, max_fanout=5, collect=True, poll_interval=0.01
+    ).run()
+    assert result.matched == 60
+    assert len(result.matches) == len(set(result.matches)) == 60
+
+
+def test_scan_coordinator_retries_failed_shards(worker, tree):
+    attempts = {}
+
+    def flaky_scan_shard(path, **kwargs):
+        attempts[path] = attempts.get(path, 0) + 1
+        if path.endswith('d1') and attempts[path] == 1:
+            raise RuntimeError('Worker lost')
+        return tasks.scan_shard.fn(path, **kwargs)
+
+    actor = dramatiq.actor(flaky_scan_shard, broker=broker)
+    result = tasks.ScanCoordinator(
+        [str(tree / 'd0'), str(tree / 'd1'), str(tree / 'missing')],
+        max_attempts=2, poll_interval=0.01, actor=actor
+    ).run()
+    assert attempts[str(tree / 'd1')] == 2
+    assert result.dirs == 2 + 20 + 1
+    assert result.files == 40
+    assert not result.failed
+
+
+def test_scan_coordinator_gives_up(worker, tree):
+    def broken_scan_shard(path, **kwargs):
+        raise RuntimeError('Broken')
+
+    actor = dramatiq.actor(broken_scan_shard, broker=broker)
+    result = tasks.ScanCoordinator(
+        [str(tree)], max_attempts=2, poll_interval=0.01, actor=actor
+    ).run()
+    assert list(result.failed) == [str(tree)]
+    assert result.shards == 0
@@ -0,0 +1,61 @@
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from admin_toolbelt.utils import (human_numeric_sort, human_numeric_top,
+                                  iter_human_numeric_sort, parse_human_numeric)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('15', 15.0),
+    ('15k', 15000.0),
+    ('1.5G', 1.5e9),
+    ('4KiB', 4096.0),
+    ('10g', 1e10),
+    ('2m', 2e6),
+    ('-3T', -3e12),
+    ('total', None),
+])
+def test_parse_human_numeric(text, expected):
+    assert parse_human_numeric(text) == expected
+
+
+def test_human_numeric_sort_orders_by_suffix():
+    lines = ['1M\ta', '1500K\tb', '2\tc', '1.5G\td', '-1K\te', '0\tf']
+    assert human_numeric_sort(lines) == ['-1K\te', '0\tf', '2\tc', '1500K\tb', '1M\ta', '1.5G\td']
+
+
+def test_human_numeric_sort_lowercase_suffixes():
+    assert human_numeric_sort(['10g', '2m', '1500k', '3', '5t']) == ['3', '1500k', '2m', '10g', '5t']
+    assert human_numeric_sort(['1g x', '1G y', '999m z'], reverse=True) == ['1g x', '1G y', '999m z']
+
+
+def test_human_numeric_sort_column():
+    lines = ['a 10K', 'b 1M', 'c 5', 'd']
+    assert human_numeric_sort(lines, column=1) == ['d', 'c 5', 'a 10K', 'b 1M']
+
+
+def test_human_numeric_top():
+    lines = ['{0}K'.format(i) for i in range(100)] + ['1M', '2g']
+    assert human_numeric_top(lines, 3) == ['2g', '1M', '99K']
+    assert human_numeric_top(lines, 2, largest=False) == ['0K', '1K']
+
+
+@pytest.mark.parametrize('run_size, max_runs', [(7, 2), (50, 3), (100000, 64)])
+@pytest.mark.skipif(shutil.which('sort') is None, reason='needs sort')
+def test_iter_human_numeric_sort_matches_sort_h(run_size, max_runs):
+    rand = random.Random(1)
+    lines = ['{0}{1}{2}\t{3}\n'.format(
+        rand.choice(['', '-']), rand.randint(0, 50), rand.choice(['', 'K', 'M', 'G', 'k', 'T']), i
+    ) for i in range(2000)]
+    expected = subprocess.run(
+        ['sort', '-s', '-h'], input=''.join(lines), stdout=subprocess.PIPE,
+        universal_newlines=True, env={'LC_ALL': 'C'}
+    ).stdout.splitlines(True)
+    result = list(iter_human_numeric_sort(lines, run_size=run_size, max_runs=max_runs))
+    assert result == expected
+    assert list(iter_human_numeric_sort(lines, run_size=run_size, reverse=True)) == (
+        human_numeric_sort(lines, reverse=True)
+    )
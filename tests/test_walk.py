@@ -0,0 +1,116 @@
+import datetime
+import logging
+import os
+import stat
+import sys
+
+import pytest
+
+from admin_toolbelt.storage import walk
+from admin_toolbelt.storage.mounts import Mount
+from admin_toolbelt.storage.walk import (LfsFindBackend, PythonScanBackend,
+                                         UnusedPeriodPolicy, select_backend, visit_dirs)
+
+# Records its arguments and prints null separated paths like lfs find
+LFS_STUB = '''#!{python}
+import sys
+with open({log!r}, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+sys.stdout.write(sys.argv[2] + '/with space\\0' + sys.argv[2] + '/new\\nline\\0' + sys.argv[2] + '/plain\\0')
+'''
+
+
+@pytest.fixture
+def lfs(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    log = tmp_path / 'lfs.log'
+    stub = bindir / 'lfs'
+    stub.write_text(LFS_STUB.format(python=sys.executable, log=str(log)))
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    return log
+
+
+def mount_of(vfstype):
+    return lambda path: Mount('fs', '/', vfstype, 'rw', '0', '0')
+
+
+def test_lfs_command():
+    policy = UnusedPeriodPolicy(datetime.timedelta(days=30, hours=1))
+    assert LfsFindBackend().command('/lustre/my dir', policy) == (
+        "lfs find '/lustre/my dir' ! -type d -atime +31 -mtime +31 -print0"
+    )
+
+
+def test_lfs_scan(lfs):
+    backend = LfsFindBackend()
+    policy = UnusedPeriodPolicy(datetime.timedelta(days=90))
+    assert backend.supports(policy)
+    assert list(backend.scan(['/lustre/a', '/lustre/b'], policy)) == [
+        '/lustre/a/with space', '/lustre/a/new\nline', '/lustre/a/plain',
+        '/lustre/b/with space', '/lustre/b/new\nline', '/lustre/b/plain',
+    ]
+    assert lfs.read_text().splitlines() == [
+        'find /lustre/a ! -type d -atime +90 -mtime +90 -print0',
+        'find /lustre/b ! -type d -atime +90 -mtime +90 -print0',
+    ]
+
+
+def test_lfs_supports(lfs):
+    class Custom(UnusedPeriodPolicy):
+        def check_stat(self, st):
+            return st.st_size > 0
+
+    backend = LfsFindBackend()
+    assert not backend.supports(None)
+    assert not backend.supports(lambda path: True)
+    assert not backend.supports(Custom())
+    assert not LfsFindBackend(lfs='no-such-lfs').supports(UnusedPeriodPolicy())
+
+
+def test_select_backend(lfs, monkeypatch):
+    policy = UnusedPeriodPolicy()
+    monkeypatch.setattr(walk, 'get_mount_info', mount_of('lustre'))
+    assert isinstance(select_backend('/lustre', policy), LfsFindBackend)
+    assert isinstance(select_backend('/lustre', None), PythonScanBackend)
+
+    monkeypatch.setattr(walk, 'get_mount_info', mount_of('ext4'))
+    backend = select_backend('/home', policy, workers=4)
+    assert isinstance(backend, PythonScanBackend)
+    assert backend.workers == 4
+
+
+def test_visit_dirs_lustre(lfs, monkeypatch, caplog):
+    monkeypatch.setattr(walk, 'get_mount_info', mount_of('lustre'))
+    found = []
+    with caplog.at_level(logging.INFO, logger=walk.__name__):
+        visit_dirs(['/lustre/a'], action=found.append, workers=8)
+    assert found == ['/lustre/a/with space', '/lustre/a/new\nline', '/lustre/a/plain']
+    assert 'lfs backend ignores workers=8' in caplog.text
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_visit_dirs_python(tmp_path, workers):
+    old = datetime.datetime.now() - datetime.timedelta(days=60)
+    for name in ('a/old', 'a/b/old', 'new'):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('x')
+    for name in ('a/old', 'a/b/old'):
+        os.utime(str(tmp_path / name), (old.timestamp(), old.timestamp()))
+
+    # Symlinks are checked by their own times, like find, whatever they point to
+    os.symlink('missing', str(tmp_path / 'a/stale'))
+    os.symlink(str(tmp_path / 'a/b'), str(tmp_path / 'a/dir'))
+    os.symlink(str(tmp_path / 'new'), str(tmp_path / 'a/recent'))
+    for name in ('a/stale', 'a/dir'):
+        os.utime(str(tmp_path / name), (old.timestamp(), old.timestamp()),
+                 follow_symlinks=False)
+
+    found = []
+    visit_dirs([str(tmp_path)], action=found.append, workers=workers,
+               backend=PythonScanBackend(workers))
+    assert sorted(found) == [
+        str(tmp_path / name) for name in ('a/b/old', 'a/dir', 'a/old', 'a/stale')
+    ]